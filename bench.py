@@ -0,0 +1,138 @@
+# bench.py
+# Server benchmark: for each board size and player count, runs a GameServer in its
+# own process, connects bots from bot.py and reports tick latency percentiles,
+# broadcast bytes per tick, server CPU and memory.
+#
+#   python3 bench.py --players 50 200 500 --sizes 20x15 64x48 --duration 10
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from config import HOST, PORT, FPS, GAME_SIZE
+from bot import spawn_bots, merge_summaries
+from scheduler import TickStats
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # peak rather than current, in KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def serve_for_bench(port, size, ctl):
+    # runs in the server process; the benchmark drives it over ctl
+    from server import GameServer
+    sys.stdout = open(os.devnull, 'w')
+    server = GameServer(HOST, port, size)
+    threading.Thread(target=server.run_async, daemon=True).start()
+    base = None
+    while True:
+        cmd = ctl.recv()
+        if cmd == 'start':
+            rooms = list(server.rooms.values())
+            for room in rooms:
+                room.scheduler.stats = TickStats(window=100000)
+            base = {
+                'time': time.perf_counter(),
+                'cpu': time.process_time(),
+                'bytes': {room.room_id: room.bytes_sent for room in rooms},
+            }
+        elif cmd == 'stop':
+            rooms = list(server.rooms.values())
+            elapsed = time.perf_counter() - base['time']
+            durations = sorted(d for room in rooms for d in room.scheduler.stats.recent)
+            sent = sum(room.bytes_sent - base['bytes'].get(room.room_id, 0) for room in rooms)
+            ctl.send({
+                'players': len(server.clients),
+                'rooms': len(rooms),
+                'ticks': len(durations),
+                'tick_p50_ms': percentile(durations, 50) * 1000,
+                'tick_p95_ms': percentile(durations, 95) * 1000,
+                'tick_p99_ms': percentile(durations, 99) * 1000,
+                'tick_max_ms': (durations[-1] if durations else 0.0) * 1000,
+                'overruns': sum(room.scheduler.stats.overruns for room in rooms),
+                'skipped': sum(room.scheduler.stats.skipped for room in rooms),
+                'bytes_per_tick': sent / max(1.0, elapsed * FPS),
+                'cpu_pct': (time.process_time() - base['cpu']) / elapsed * 100,
+                'rss_mb': rss_bytes() / (1 << 20),
+            })
+        else:
+            return
+
+def wait_for_port(port, timeout=10):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def bench_once(players, size, duration, warmup, processes, port):
+    ctl, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_for_bench, args=(port, size, child), daemon=True)
+    server.start()
+    try:
+        if not wait_for_port(port):
+            raise RuntimeError(f"server did not start on port {port}")
+        procs, results = spawn_bots(players, processes, warmup + duration + 1, HOST, port, size)
+        time.sleep(warmup)
+        ctl.send('start')
+        time.sleep(duration)
+        ctl.send('stop')
+        stats = ctl.recv()
+        bots = merge_summaries(results.get() for _ in procs)
+        rtts = sorted(bots['rtts'])
+        stats['connected'] = bots['bots']
+        stats['rtt_p50_ms'] = percentile(rtts, 50) * 1000
+        stats['rtt_p99_ms'] = percentile(rtts, 99) * 1000
+        return stats
+    finally:
+        ctl.send('exit')
+        server.join(2)
+        if server.is_alive():
+            server.terminate()
+
+COLUMNS = [
+    ('board', '{:>7}'), ('players', '{:>7}'), ('rooms', '{:>5}'),
+    ('tick_p50_ms', '{:>8.2f}'), ('tick_p95_ms', '{:>8.2f}'), ('tick_p99_ms', '{:>8.2f}'), ('tick_max_ms', '{:>8.2f}'),
+    ('overruns', '{:>8}'), ('bytes_per_tick', '{:>10.0f}'), ('cpu_pct', '{:>6.1f}'), ('rss_mb', '{:>7.1f}'),
+    ('rtt_p50_ms', '{:>8.2f}'), ('rtt_p99_ms', '{:>8.2f}'),
+]
+HEADERS = ['board', 'players', 'rooms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'overrun', 'B/tick', 'cpu%', 'rss MB', 'rtt p50', 'rtt p99']
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return (int(w), int(h))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the game server with headless bots.')
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[GAME_SIZE])
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per run')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds for bots to connect before measuring')
+    parser.add_argument('--processes', type=int, default=0, help='bot processes, 0 = one per 250 bots')
+    parser.add_argument('--port', type=int, default=PORT + 1)
+    args = parser.parse_args()
+
+    widths = [len(fmt.format(0 if 'f' in fmt else '')) for _, fmt in COLUMNS]
+    print(' '.join(h.rjust(w) for h, w in zip(HEADERS, widths)))
+    for size in args.sizes:
+        for players in args.players:
+            processes = args.processes or max(1, min(players // 250 + 1, multiprocessing.cpu_count()))
+            stats = bench_once(players, size, args.duration, args.warmup, processes, args.port)
+            stats['board'] = f"{size[0]}x{size[1]}"
+            stats['players'] = stats.pop('connected')
+            print(' '.join(fmt.format(stats[key]) for key, fmt in COLUMNS), flush=True)
@@ -0,0 +1,226 @@
+# bot.py
+# Headless players for load testing. A bot speaks the same protocol as SnakeClient
+# (login, start, input, ping) but needs no display; one process multiplexes many
+# bots on a selector and several processes can be started side by side.
+#
+#   python3 bot.py [bots] [processes] [seconds]
+import socket
+import selectors
+import multiprocessing
+import random
+import time
+import sys
+from config import HOST, PORT, LOGIN_KEY, GAME_SIZE, WIRE_FORMAT, MSG_LOGIN, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_DELTA, MSG_PING, MSG_PONG, MSG_DISCONNECT, MSG_LOSE, DIRS
+from protocol import FORMAT_JSON, FORMATS, MessageReader, encode_msg
+
+OPPOSITE = {'UP': 'DOWN', 'DOWN': 'UP', 'LEFT': 'RIGHT', 'RIGHT': 'LEFT'}
+
+class BotClient:
+    def __init__(self, host=HOST, port=PORT, size=GAME_SIZE, fmt=WIRE_FORMAT, turn_chance=0.1):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.fmt = fmt
+        self.turn_chance = turn_chance
+        self.sock = None
+        self.reader = MessageReader()
+        self.my_id = None
+        self.slot = None
+        self.head = None
+        self.direction = 'RIGHT'
+        self.input_seq = 0
+        self.alive = True
+        self.connected = False
+        self.last_ping = 0.0
+        self.ping_sent = None
+        self.rtts = []
+        self.bytes_in = 0
+        self.updates = 0
+
+    def connect(self):
+        # same handshake as SnakeClient.connect, without the prompt
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.sendall(encode_msg({'id': MSG_LOGIN, 'key': LOGIN_KEY, 'format': self.fmt}))
+        while True:
+            resp = self.reader.next_message()
+            if resp is not None:
+                break
+            if not self.reader.recv_into(self.sock):
+                return False
+        if not resp.get('ok'):
+            self.sock.close()
+            return False
+        fmt = resp.get('format', FORMAT_JSON)
+        self.fmt = fmt if fmt in FORMATS else FORMAT_JSON
+        self.reader.fmt = self.fmt
+        self.my_id = resp.get('cid')
+        self.sock.sendall(encode_msg({'id': MSG_START}, self.fmt))
+        self.sock.setblocking(False)
+        self.connected = True
+        return True
+
+    def send(self, msg):
+        try:
+            self.sock.send(encode_msg(msg, self.fmt))
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+
+    def on_readable(self):
+        try:
+            n = self.reader.recv_into(self.sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self.close()
+            return
+        self.bytes_in += n
+        while True:
+            msg = self.reader.next_message()
+            if msg is None:
+                break
+            self.handle(msg)
+
+    def handle(self, msg):
+        if msg['id'] == MSG_UPDATE:
+            self.updates += 1
+            if 'snakes' in msg:
+                self.slot = msg['ids'].index(self.my_id) if self.my_id in msg['ids'] else None
+                if self.slot is not None:
+                    self.head = tuple(msg['snakes'][self.slot][0])
+            else:
+                # view keyframe: [slot, value, ...] lists like a delta
+                ids, add = msg.get('ids', []), msg.get('add', [])
+                self.slot = None
+                for i in range(0, len(ids), 2):
+                    if ids[i+1] == self.my_id:
+                        self.slot = ids[i]
+                for i in range(0, len(add), 2):
+                    if add[i] == self.slot:
+                        self.head = tuple(add[i+1][0])
+        elif msg['id'] == MSG_DELTA:
+            self.updates += 1
+            move = msg.get('move', [])
+            for i in range(0, len(move), 4):
+                if move[i] == self.slot:
+                    self.head = (move[i+1], move[i+2])
+        elif msg['id'] == MSG_PONG:
+            if self.ping_sent is not None:
+                self.rtts.append(time.perf_counter() - self.ping_sent)
+                self.ping_sent = None
+        elif msg['id'] == MSG_DISCONNECT and msg.get('cid') == self.my_id:
+            self.close()
+        elif msg['id'] == MSG_LOSE and msg.get('cid') == self.my_id:
+            self.alive = False
+
+    def safe(self, direction):
+        if self.head is None:
+            return True
+        dx, dy = DIRS[direction]
+        x, y = self.head[0] + dx, self.head[1] + dy
+        return 0 <= x < self.size[0] and 0 <= y < self.size[1]
+
+    def think(self, now):
+        if not self.connected:
+            return
+        if now - self.last_ping > 1:
+            self.last_ping = now
+            msg = {'id': MSG_PING}
+            if self.rtts:
+                msg['rtt'] = int(self.rtts[-1] * 1e6)
+            self.ping_sent = time.perf_counter()
+            self.send(msg)
+        if not self.alive:
+            return
+        # wander at random, but turn away from walls
+        options = [d for d in DIRS if d != OPPOSITE[self.direction] and self.safe(d)]
+        if options and (not self.safe(self.direction) or random.random() < self.turn_chance):
+            direction = random.choice(options)
+            if direction != self.direction:
+                self.direction = direction
+                self.input_seq += 1
+                self.send({'id': MSG_INPUT, 'dir': direction, 'seq': self.input_seq})
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+def run_bots(count, duration, host=HOST, port=PORT, size=GAME_SIZE, results=None, think_every=0.05):
+    sel = selectors.DefaultSelector()
+    bots = []
+    failed = 0
+    for _ in range(count):
+        bot = BotClient(host, port, size)
+        try:
+            if not bot.connect():
+                failed += 1
+                continue
+        except OSError:
+            failed += 1
+            continue
+        sel.register(bot.sock, selectors.EVENT_READ, bot)
+        bots.append(bot)
+    end = time.monotonic() + duration
+    next_think = 0.0
+    while time.monotonic() < end:
+        for key, _ in sel.select(timeout=think_every):
+            bot = key.data
+            bot.on_readable()
+            if not bot.connected:
+                sel.unregister(key.fileobj)
+        now = time.monotonic()
+        if now >= next_think:
+            next_think = now + think_every
+            for bot in bots:
+                bot.think(now)
+    summary = {
+        'bots': len(bots),
+        'failed': failed,
+        'connected': sum(1 for b in bots if b.connected),
+        'bytes_in': sum(b.bytes_in for b in bots),
+        'updates': sum(b.updates for b in bots),
+        'rtts': [rtt for b in bots for rtt in b.rtts],
+    }
+    for bot in bots:
+        bot.close()
+    if results is not None:
+        results.put(summary)
+    return summary
+
+def spawn_bots(count, processes, duration, host=HOST, port=PORT, size=GAME_SIZE):
+    # returns the processes and a queue that receives one summary per process
+    results = multiprocessing.Queue()
+    procs = []
+    for i in range(processes):
+        share = count // processes + (1 if i < count % processes else 0)
+        if share:
+            p = multiprocessing.Process(target=run_bots, args=(share, duration, host, port, size, results), daemon=True)
+            p.start()
+            procs.append(p)
+    return procs, results
+
+def merge_summaries(summaries):
+    merged = {'bots': 0, 'failed': 0, 'connected': 0, 'bytes_in': 0, 'updates': 0, 'rtts': []}
+    for summary in summaries:
+        for k in merged:
+            merged[k] += summary[k]
+    return merged
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else max(1, min(count // 250, multiprocessing.cpu_count()))
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+    procs, results = spawn_bots(count, processes, duration)
+    total = merge_summaries(results.get() for _ in procs)
+    rtts = sorted(total['rtts'])
+    print(f"{total['bots']} bots connected ({total['failed']} failed), {total['connected']} still connected")
+    print(f"received {total['bytes_in']} bytes in {total['updates']} updates")
+    if rtts:
+        print(f"rtt p50 {rtts[len(rtts)//2]*1000:.1f} ms, p99 {rtts[int(len(rtts)*0.99)]*1000:.1f} ms")
@@ -1,12 +1,13 @@
 import socket
 import threading
 import time
-import json
 import pygame
 import random
-from config import HOST, PORT, LOGIN_KEY, FPS, GAME_SIZE, MSG_LOGIN, MSG_LOGIN_RESP, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_PING, MSG_PONG, MSG_DISCONNECT, DIRS
+from collections import deque, namedtuple
+from config import HOST, PORT, LOGIN_KEY, RENDER_FPS, GAME_SIZE, VIEW_SIZE, MSG_LOGIN, MSG_LOGIN_RESP, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_DELTA, MSG_PING, MSG_PONG, MSG_DISCONNECT, MSG_WIN, MSG_LOSE, WIRE_FORMAT, TRANSPORT, INPUT_REDUNDANCY, KEYFRAME_INTERVAL, DIRS
+from protocol import FORMAT_JSON, FORMATS, MessageReader, encode_msg, decode_msg
+from render import CELL_SIZE, Renderer
 
-CELL_SIZE = 32
 DIR_KEYS = {pygame.K_UP: 'UP', pygame.K_DOWN: 'DOWN', pygame.K_LEFT: 'LEFT', pygame.K_RIGHT: 'RIGHT'}
 
 NEON_COLORS = [
@@ -16,31 +17,60 @@ NEON_COLORS = [
     (255,255,0),
     (0,191,255),
 ]
-SEGMENT_COLORS = [
-    (0,200,0),
-    (240,200,0),
-    (0,120,255),
-]
+
+OPPOSITES = {('UP','DOWN'),('DOWN','UP'),('LEFT','RIGHT'),('RIGHT','LEFT')}
+
+def heading(body):
+    # direction the snake last moved in, from its first two segments
+    if len(body) < 2:
+        return None
+    step = (body[0][0] - body[1][0], body[0][1] - body[1][1])
+    return next((name for name, d in DIRS.items() if d == step), None)
+
+# one server tick as the client knows it. snakes, scores, ids (client id) and
+# acks are lists indexed by player slot, None where a slot is free. The receive
+# threads build a new World per snapshot and publish it with a single
+# assignment; a published World (and the lists in it) is never modified, so
+# readers need no lock.
+World = namedtuple('World', ['tick', 'snakes', 'fruit', 'scores', 'ids', 'acks'])
+EMPTY_WORLD = World(None, [], None, [], [], [])
+
+def pair_items(flat):
+    # [slot, value, slot, value, ...] -> (slot, value) pairs
+    return zip(flat[::2], flat[1::2])
 
 class SnakeClient:
     def __init__(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.snakes = {}
-        self.fruit = None
-        self.scores = {}
-        self.players = {}
+        self.reader = MessageReader()
+        self.fmt = FORMAT_JSON
+        self.world = EMPTY_WORLD
         self.my_id = None
         self.running = True
         self.last_update = time.time()
+        # (previous world, current world, arrival time), what the renderer interpolates
+        self.snapshots = (EMPTY_WORLD, EMPTY_WORLD, self.last_update)
         self.last_ping = time.time()
+        self.ping_sent = None
+        self.rtt = None
         self.predicted_dir = 'RIGHT'
-        self.predicted_body = []
+        self.predicted_body = deque()
         self.instant_move = False
         self.simulate_lag = False
         self.lag_loss = 0.3
         self.ack_pending = False
+        # inputs not yet acknowledged by the server, replayed on top of each update
+        self.input_seq = 0
+        self.pending_inputs = deque()
+        self.unsent_inputs = deque()
         self.win_cid = None
         self.lose_cid = None
+        self.have_keyframe = False
+        # snapshots arrive on the TCP and the UDP thread, this only orders those two writers
+        self.lock = threading.Lock()
+        self.udp = None
+        self.udp_token = None
+        self.udp_bound = False
 
     def connect(self):
         self.sock.connect((HOST, PORT))
@@ -48,78 +78,226 @@ class SnakeClient:
             key = input('LOGIN - Insert key: ')
         except:
             key = LOGIN_KEY
-        self.sock.send((json.dumps({'id': MSG_LOGIN, 'key': key}) + '\n').encode())
-        buffer = ''
+        self.sock.send(encode_msg({'id': MSG_LOGIN, 'key': key, 'format': WIRE_FORMAT, 'udp': TRANSPORT == 'udp'}))
         while True:
-            data = self.sock.recv(1024)
-            if not data:
+            resp = self.reader.next_message()
+            if resp is not None:
+                break
+            if not self.reader.recv_into(self.sock):
                 print('No response from server')
                 return False
-            buffer += data.decode()
-            if '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                resp = json.loads(line)
-                break
         if not resp.get('ok'):
             print('Login failed')
             self.sock.close()
             return False
+        # anything after the login response is in the negotiated format
+        fmt = resp.get('format', FORMAT_JSON)
+        self.fmt = fmt if fmt in FORMATS else FORMAT_JSON
+        self.reader.fmt = self.fmt
+        self.my_id = resp.get('cid')
+        if 'udp_port' in resp:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.connect((HOST, resp['udp_port']))
+            self.udp_token = resp['token']
         self.login_succeeded = True
         return True
 
+    def udp_hello(self):
+        # json like the TCP login, the server doesn't know our format until it knows us
+        hello = {'id': MSG_LOGIN, 'cid': self.my_id, 'token': self.udp_token}
+        try:
+            self.udp.send(encode_msg(hello))
+        except OSError:
+            pass
+
     def send_input(self, direction):
-        if self.simulate_lag and random.random() < self.lag_loss:
-            self.ack_pending = True
+        self.input_seq += 1
+        self.pending_inputs.append((self.input_seq, direction))
+        if self.udp_bound:
+            self.send_udp_inputs()
             return
-        self.sock.send((json.dumps({'id': MSG_INPUT, 'dir': direction}) + '\n').encode())
-        self.ack_pending = False
+        self.unsent_inputs.append((self.input_seq, direction))
+        self.flush_inputs()
+
+    def send_udp_inputs(self):
+        # every datagram repeats the newest unacknowledged inputs, so one that is
+        # lost is covered by the next; lag simulation drops whole datagrams
+        if not self.pending_inputs or (self.simulate_lag and random.random() < self.lag_loss):
+            return
+        inputs = [[seq, direction] for seq, direction in list(self.pending_inputs)[-INPUT_REDUNDANCY:]]
+        try:
+            self.udp.send(encode_msg({'id': MSG_INPUT, 'inputs': inputs}, self.fmt))
+        except OSError:
+            pass
+
+    def flush_inputs(self):
+        # inputs go out in order, the lag simulation holds them back like a lost packet
+        while self.unsent_inputs:
+            if self.simulate_lag and random.random() < self.lag_loss:
+                break
+            seq, direction = self.unsent_inputs[0]
+            self.sock.send(encode_msg({'id': MSG_INPUT, 'dir': direction, 'seq': seq}, self.fmt))
+            self.unsent_inputs.popleft()
+        self.ack_pending = bool(self.unsent_inputs)
 
     def ping(self):
-        self.sock.send((json.dumps({'id': MSG_PING}) + '\n').encode())
+        msg = {'id': MSG_PING}
+        if self.rtt is not None:
+            # lets the server see round trips, in microseconds
+            msg['rtt'] = int(self.rtt * 1e6)
+        self.ping_sent = time.time()
+        self.sock.send(encode_msg(msg, self.fmt))
 
     def recv_thread(self):
-        buffer = ''
         while self.running:
             try:
-                data = self.sock.recv(1024)
-                if not data:
+                if not self.reader.recv_into(self.sock):
                     break
-                buffer += data.decode()
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if not line.strip():
-                        continue
+                while True:
                     try:
-                        msg = json.loads(line)
+                        msg = self.reader.next_message()
                     except Exception as e:
                         print('Error decoding:', e)
                         continue
-                    if msg['id'] == MSG_UPDATE:
-                        self.snakes = msg['snakes']
-                        self.fruit = msg['fruit']
-                        self.scores = msg['scores']
-                        self.players = msg.get('players', {})
-                        self.last_update = time.time()
-                        if self.my_id and self.instant_move:
-                            my_key = str(self.my_id)
-                            if my_key in self.snakes:
-                                self.predicted_body = self.snakes[my_key]
+                    if msg is None:
+                        break
+                    if msg['id'] in (MSG_UPDATE, MSG_DELTA):
+                        with self.lock:
+                            self.on_snapshot(msg)
                     elif msg['id'] == MSG_PONG:
                         self.last_ping = time.time()
+                        if self.ping_sent is not None:
+                            self.rtt = self.last_ping - self.ping_sent
+                            self.ping_sent = None
                     elif msg['id'] == MSG_DISCONNECT:
-                        self.running = False
-                        print('Disconnected by server')
-                        break
-                    elif msg['id'] == 'win':
+                        # the same message tells the room a player left
+                        if msg.get('cid') == self.my_id:
+                            self.running = False
+                            print('Disconnected by server')
+                            break
+                    elif msg['id'] == MSG_WIN:
                         self.win_cid = msg['cid']
-                    elif msg['id'] == 'lose':
+                    elif msg['id'] == MSG_LOSE:
                         self.lose_cid = msg['cid']
             except Exception as e:
                 print('Error:', e)
                 break
         self.running = False
 
+    def udp_thread(self):
+        self.udp.settimeout(0.5)
+        while self.running:
+            if not self.udp_bound:
+                self.udp_hello()
+            try:
+                data = self.udp.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                msg = decode_msg(data, self.fmt)
+            except ValueError:
+                continue
+            if msg['id'] == MSG_LOGIN_RESP:
+                self.udp_bound = True
+            elif msg['id'] == MSG_UPDATE:
+                self.udp_bound = True
+                with self.lock:
+                    self.on_snapshot(msg)
+                # keep repeating inputs until the server acknowledges them
+                self.send_udp_inputs()
+
+    def on_snapshot(self, msg):
+        tick = msg.get('tick')
+        if msg['id'] == MSG_UPDATE:
+            # datagrams can arrive late or out of order, an older tick is dropped.
+            # Ticks restart in a new room, so only a recent one counts as older.
+            last = self.world.tick
+            if self.have_keyframe and tick is not None and last is not None \
+                    and last - KEYFRAME_INTERVAL < tick <= last:
+                return
+            self.have_keyframe = True
+            if 'snakes' in msg:
+                self.publish(World(tick, msg['snakes'], msg['fruit'], msg['scores'], msg['ids'], msg['acks']))
+            else:
+                # a view keyframe lists only the slots in sight, like a delta from nothing
+                self.publish(self.apply_delta(EMPTY_WORLD, msg))
+        elif self.have_keyframe and tick == self.world.tick + 1:
+            self.publish(self.apply_delta(self.world, msg))
+        else:
+            # missed a tick, wait for the next keyframe
+            self.have_keyframe = False
+
+    def apply_delta(self, world, msg):
+        # copies what changes, the world passed in stays as it was
+        snakes, scores, ids, acks = list(world.snakes), list(world.scores), list(world.ids), list(world.acks)
+        add = msg.get('add', [])
+        size = max([len(ids)] + [slot + 1 for slot in add[::2]])
+        if size > len(ids):
+            for values in (snakes, scores, ids):
+                values.extend([None] * (size - len(values)))
+            acks.extend([0] * (size - len(acks)))
+        for slot in msg.get('remove', []):
+            snakes[slot] = scores[slot] = ids[slot] = None
+            acks[slot] = 0
+        for slot, body in pair_items(add):
+            snakes[slot] = body
+        move = msg.get('move', [])
+        for i in range(0, len(move), 4):
+            slot, x, y, length = move[i:i+4]
+            snakes[slot] = ([[x, y]] + snakes[slot])[:length]
+        for key, values in (('scores', scores), ('ids', ids), ('acks', acks)):
+            for slot, value in pair_items(msg.get(key, [])):
+                values[slot] = value
+        fruit = msg['fruit'] if 'fruit' in msg else world.fruit
+        return World(msg['tick'], snakes, fruit, scores, ids, acks)
+
+    def my_slot(self, world):
+        return world.ids.index(self.my_id) if self.my_id in world.ids else None
+
+    def publish(self, world):
+        self.world = world
+        self.last_update = time.time()
+        self.snapshots = (self.snapshots[1], world, self.last_update)
+        slot = self.my_slot(world)
+        if slot is not None:
+            self.reconcile(world, slot)
+
+    def reconcile(self, world, slot):
+        # prediction = authoritative body + every input the server hasn't applied yet
+        acked = world.acks[slot]
+        while self.pending_inputs and self.pending_inputs[0][0] <= acked:
+            self.pending_inputs.popleft()
+        body = world.snakes[slot]
+        if not self.instant_move or not body:
+            return
+        predicted = deque(tuple(p) for p in body)
+        direction = heading(body)
+        for _, desired in list(self.pending_inputs):
+            if direction and (direction, desired) in OPPOSITES:
+                continue
+            direction = desired
+            dx, dy = DIRS[direction]
+            predicted.appendleft((predicted[0][0]+dx, predicted[0][1]+dy))
+            predicted.pop()
+        self.predicted_dir = direction or self.predicted_dir
+        self.predicted_body = predicted
+
     # user interface
+    def camera(self, view):
+        # top-left cell of the view, following our head and stopping at the board edges
+        if view == GAME_SIZE:
+            return (0, 0)
+        world = self.world
+        slot = self.my_slot(world)
+        body = self.predicted_body if self.instant_move and self.predicted_body else (world.snakes[slot] if slot is not None else None)
+        if not body:
+            return ((GAME_SIZE[0] - view[0]) // 2, (GAME_SIZE[1] - view[1]) // 2)
+        hx, hy = body[0]
+        return (min(max(hx - view[0] // 2, 0), GAME_SIZE[0] - view[0]),
+                min(max(hy - view[1] // 2, 0), GAME_SIZE[1] - view[1]))
+
     def draw_neon_border(self, screen, t):
         w, h = screen.get_width(), screen.get_height()
         pad = 24
@@ -136,14 +314,18 @@ class SnakeClient:
         if not self.connect():
             return
         threading.Thread(target=self.recv_thread, daemon=True).start()
+        if self.udp:
+            threading.Thread(target=self.udp_thread, daemon=True).start()
         pygame.init()
-        screen = pygame.display.set_mode((GAME_SIZE[0]*CELL_SIZE, GAME_SIZE[1]*CELL_SIZE))
+        # on boards larger than VIEW_SIZE the window scrolls with our snake
+        view = (min(VIEW_SIZE[0], GAME_SIZE[0]), min(VIEW_SIZE[1], GAME_SIZE[1])) if VIEW_SIZE else GAME_SIZE
+        screen = pygame.display.set_mode((view[0]*CELL_SIZE, view[1]*CELL_SIZE))
         clock = pygame.time.Clock()
-        self.my_id = self.sock.getsockname()[1]
 
         font_title = pygame.font.SysFont('Courier', 64, bold=True)
         font_menu = pygame.font.SysFont('Courier', 28, bold=True)
         font_hud = pygame.font.SysFont('Courier', 22, bold=True)
+        renderer = Renderer(screen, font_hud)
 
         # start screen
         started = False
@@ -162,7 +344,7 @@ class SnakeClient:
                     elif event.key in (pygame.K_RETURN, pygame.K_SPACE):
                         if start_options[menu_index] == 'Start Game':
                             if hasattr(self, 'login_succeeded') and self.login_succeeded:
-                                self.sock.send((json.dumps({'id': MSG_START}) + '\n').encode())
+                                self.sock.send(encode_msg({'id': MSG_START}, self.fmt))
                                 started = True
                         else:
                             pygame.quit(); self.sock.close(); return
@@ -191,10 +373,12 @@ class SnakeClient:
                 elif event.type == pygame.KEYDOWN:
                     if event.key in DIR_KEYS:
                         desired = DIR_KEYS[event.key]
-                        if self.instant_move and self.predicted_body:
+                        if self.instant_move and self.predicted_body and (self.predicted_dir, desired) not in OPPOSITES:
                             dx, dy = DIRS[desired]
                             head = (self.predicted_body[0][0]+dx, self.predicted_body[0][1]+dy)
-                            self.predicted_body = [head] + self.predicted_body[:-1]
+                            self.predicted_body.appendleft(head)
+                            self.predicted_body.pop()
+                            self.predicted_dir = desired
                         self.send_input(desired)
                     elif event.key == pygame.K_l:
                         self.simulate_lag = not self.simulate_lag
@@ -206,63 +390,11 @@ class SnakeClient:
             if time.time() - self.last_ping > 1:
                 self.ping()
             if self.ack_pending:
-                self.send_input(self.predicted_dir)
+                self.flush_inputs()
 
             # render
-            screen.fill((5, 5, 25))
-
-            # apple
-            if self.fruit:
-                fx, fy = self.fruit
-                cx = fx*CELL_SIZE + CELL_SIZE//2
-                cy = fy*CELL_SIZE + CELL_SIZE//2
-                pygame.draw.circle(screen, (220,0,0), (cx, cy), CELL_SIZE//2 - 4)
-                stem_rect = pygame.Rect(0,0,6,12)
-                stem_rect.center = (cx, cy - CELL_SIZE//2 + 6)
-                pygame.draw.rect(screen, (0,180,0), stem_rect, border_radius=3)
-
-            # snakes colors
-            for cid, body in self.snakes.items():
-                cid_str = str(cid)
-                is_me = cid_str == str(self.my_id)
-                for idx, (x, y) in enumerate(body):
-                    color = SEGMENT_COLORS[idx % len(SEGMENT_COLORS)]
-                    rect = pygame.Rect(x*CELL_SIZE, y*CELL_SIZE, CELL_SIZE, CELL_SIZE)
-                    pygame.draw.rect(screen, color, rect, border_radius=6)
-                    if is_me and idx == 0:
-                        pygame.draw.rect(screen, (255,255,255), rect.inflate(6,6), 2, border_radius=8)
-
-            # predicted overlay
-            if self.instant_move and self.predicted_body:
-                for x, y in self.predicted_body:
-                    pygame.draw.rect(screen, (255,255,0), (x*CELL_SIZE, y*CELL_SIZE, CELL_SIZE, CELL_SIZE), 2, border_radius=6)
-
-            # points
-            y = 6
-            for cid, score in sorted(self.scores.items(), key=lambda kv: int(kv[0])):
-                txt = f"Player {cid} points: {score}"
-                surf = font_hud.render(txt, True, (255,255,255))
-                screen.blit(surf, (6, y))
-                y += 22
-
-            # show other players info under HUD
-            if self.players:
-                y += 6
-                surf = font_hud.render('Other players:', True, (200,200,200))
-                screen.blit(surf, (6, y))
-                y += 20
-                for cid, meta in sorted(self.players.items(), key=lambda kv: int(kv[0])):
-                    # skip self
-                    if str(cid) == str(self.my_id):
-                        continue
-                    pscore = self.scores.get(str(cid), self.scores.get(cid, 0))
-                    txt = f"{cid} — {pscore} pts"
-                    surf = font_hud.render(txt, True, (220,220,220))
-                    screen.blit(surf, (6, y))
-                    y += 18
-
-            pygame.display.flip()
-            clock.tick(FPS)
+            renderer.draw(self, self.camera(view), time.time())
+            clock.tick(RENDER_FPS)
 
             # check win/lose overlays
             if self.win_cid is not None or self.lose_cid == self.my_id:
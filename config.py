@@ -3,9 +3,36 @@ HOST = '127.0.0.1'
 PORT = 65432
 LOGIN_KEY = '1234'
 FPS = 4
+RENDER_FPS = 60  # client frame rate, snakes are interpolated between server ticks
+TICK_POLICY = 'catchup'  # when a room falls behind: 'catchup' runs missed ticks, 'skip' drops them
+MAX_CATCHUP_TICKS = 5  # most ticks run back to back in one wakeup
 GAME_SIZE = (20, 15)  # width, height
+VIEW_SIZE = None  # (width, height) around a player's head it is sent and shown, for large boards; None = whole board
+AOI_BUCKET = 8  # cells per side of a spatial index bucket when VIEW_SIZE is set
 SNAKE_LEN = 4
+INPUT_BUFFER = 8  # turns a snake can have queued, one is applied per tick
 WIN_SCORE = 100
+BODY_COLLISIONS = False  # die when running into any snake body, including your own
+ROOM_SIZE = 8  # players per match, the server opens as many rooms as needed
+SERVER_MODE = 'async'  # 'async' (single event loop) or 'threaded' (thread per client)
+LISTEN_BACKLOG = 1024
+RECV_BUFFER = 4096  # initial receive buffer per connection, grows for larger messages
+MAX_MESSAGE = 16 * 1024 * 1024  # longest frame or JSON line accepted before the connection is dropped
+OUTBOUND_HIGH_WATER = 64 * 1024  # bytes in the socket buffer before a client's updates start queueing
+MAX_OUTBOUND_BYTES = 1024 * 1024  # queued bytes before a client counts as too slow and is dropped
+MAX_DROPPED_SNAPSHOTS = 40  # world snapshots a client may miss in a row before it is dropped
+DELTA_UPDATES = True
+KEYFRAME_INTERVAL = 40  # ticks between full snapshots in delta mode
+WIRE_FORMAT = 'binary'  # format the client asks for at login: 'binary' or 'json'
+TRANSPORT = 'tcp'  # 'udp' has the client take world state and send inputs over UDP, events stay on TCP
+UDP_ENABLED = True  # server offers the UDP channel, on the same port number as TCP
+MAX_DATAGRAM = 1200  # bigger snapshots fall back to the TCP stream
+INPUT_REDUNDANCY = 4  # unacknowledged inputs repeated in every input datagram
+ROUTER_WORKERS = 0  # worker processes behind router.py, 0 = one per core
+HEALTH_INTERVAL = 1.0  # seconds between worker load reports to the router
+METRICS_PORT = None  # local HTTP port for /metrics and /profile (see metrics.py), router workers use METRICS_PORT + index; None = off
+REPLAY_DIR = None  # directory every room records its match to (see replay.py), None = off
+REPLAY_KEYFRAME_INTERVAL = 400  # ticks between full room states in a recording, what seeking starts from
 
 # Message IDs
 MSG_LOGIN = 'login'
@@ -13,9 +40,13 @@ MSG_LOGIN_RESP = 'login_resp'
 MSG_START = 'start'
 MSG_INPUT = 'input'
 MSG_UPDATE = 'update'
+MSG_DELTA = 'delta'
 MSG_PING = 'ping'
 MSG_PONG = 'pong'
 MSG_DISCONNECT = 'disconnect'
+MSG_WIN = 'win'
+MSG_LOSE = 'lose'
+MSG_HEALTH = 'health'  # worker -> router, not sent to clients
 
 # Directions
 DIRS = {'UP': (0, -1), 'DOWN': (0, 1), 'LEFT': (-1, 0), 'RIGHT': (1, 0)}
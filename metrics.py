@@ -0,0 +1,165 @@
+# metrics.py
+# Counters and histograms for the server, served as plain text (Prometheus
+# exposition format) on a local HTTP port when METRICS_PORT is set, plus cProfile
+# captures of room ticks on demand:
+#
+#   curl localhost:9100/metrics
+#   curl 'localhost:9100/profile?seconds=5'
+#
+# Updates are plain adds from the tick and network threads, cheap enough to
+# leave on; a reading taken while they run may be a tick out of date.
+import bisect
+import cProfile
+import io
+import pstats
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# upper bounds in seconds, from 50us to a whole second
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+MAX_PROFILE_SECONDS = 60
+
+def series(name, suffix='', label=''):
+    # name may carry labels, name{phase="move"}; label is added to them
+    base, _, labels = name.partition('{')
+    labels = ','.join(part for part in (labels.rstrip('}'), label) if part)
+    return f"{base}{suffix}{{{labels}}}" if labels else base + suffix
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name):
+        total = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), self.counts):
+            total += n
+            le = f'le="{bound}"'
+            yield f"{series(name, '_bucket', le)} {total}"
+        yield f"{series(name, '_sum')} {self.sum:.6f}"
+        yield f"{series(name, '_count')} {self.count}"
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # callables returning [(kind, name, value)], read at every scrape
+        self.collectors = []
+        self.profiler = None
+        self.profile_lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def render(self):
+        lines = []
+        typed = set()
+        def header(name, kind):
+            base = name.partition('{')[0]
+            if base not in typed:
+                typed.add(base)
+                lines.append(f"# TYPE {base} {kind}")
+        for name, value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name} {value}")
+        for name, histogram in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            lines.extend(histogram.lines(name))
+        for collect in self.collectors:
+            for kind, name, value in collect():
+                header(name, kind)
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def profiled(self, fn):
+        # runs fn under the profiler while a capture is on. One profiler is shared
+        # by every room thread, so profiled ticks take turns
+        if self.profiler is None:
+            return fn()
+        with self.profile_lock:
+            profiler = self.profiler
+            if profiler is None:
+                return fn()
+            return profiler.runcall(fn)
+
+    def profile(self, seconds):
+        # profiles every room tick for a while, returns the report as text
+        with self.profile_lock:
+            if self.profiler is not None:
+                return "a capture is already running\n"
+            profiler = self.profiler = cProfile.Profile()
+        time.sleep(seconds)
+        with self.profile_lock:
+            self.profiler = None
+        out = io.StringIO()
+        try:
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        except TypeError:
+            # nothing ran while it was on
+            return "no ticks ran during the capture\n"
+        return out.getvalue()
+
+class TimedLock:
+    # a Lock that records how long each acquire waited
+    def __init__(self, metrics, name):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.metrics.observe(self.name, time.perf_counter() - started)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            body = self.server.metrics.render()
+        elif url.path == '/profile':
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', ['5'])[0])
+            except ValueError:
+                seconds = 5
+            body = self.server.metrics.profile(min(max(seconds, 0.1), MAX_PROFILE_SECONDS))
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(metrics, host, port):
+    # answers on its own threads, whatever the server mode
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return httpd
@@ -0,0 +1,280 @@
+# protocol.py
+# Wire formats shared by server and client.
+#
+# json:   one JSON object per line
+# binary: [u32 length][u8 message code][payload], length counts code + payload.
+#         The payload is a tagged value encoding where small ints, known strings
+#         and board coordinates take one or two bytes each.
+# Over UDP every datagram holds exactly one message in the same encoding.
+import json
+import struct
+from config import RECV_BUFFER, MAX_MESSAGE, MSG_LOGIN, MSG_LOGIN_RESP, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_DELTA, MSG_PING, MSG_PONG, MSG_DISCONNECT, MSG_WIN, MSG_LOSE
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+
+# message code byte, 0 means the id travels inside the payload
+MSG_CODES = {
+    MSG_LOGIN: 1,
+    MSG_LOGIN_RESP: 2,
+    MSG_START: 3,
+    MSG_INPUT: 4,
+    MSG_UPDATE: 5,
+    MSG_DELTA: 6,
+    MSG_PING: 7,
+    MSG_PONG: 8,
+    MSG_DISCONNECT: 9,
+    MSG_WIN: 10,
+    MSG_LOSE: 11,
+}
+MSG_NAMES = {code: name for name, code in MSG_CODES.items()}
+
+# strings encoded as a single byte, append only (at most 64)
+INTERNED = (
+    'id', 'ok', 'key', 'format', 'dir', 'cid',
+    'snakes', 'fruit', 'scores', 'players',
+    'move', 'add', 'remove',
+    'UP', 'DOWN', 'LEFT', 'RIGHT',
+    'tick', 'seq', 'acks',
+    'inputs', 'token', 'udp', 'udp_port',
+    'ids', 'rtt',
+)
+INTERN_INDEX = {s: i for i, s in enumerate(INTERNED)}
+
+HEADER = struct.Struct('!IB')
+FLOAT = struct.Struct('!d')
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_STR, T_LIST, T_DICT, T_POINT, T_POINTS, T_FLOAT = range(10)
+T_INTERN = 0x40  # 0x40-0x7f: index into INTERNED
+T_SMALL = 0x80   # 0x80-0xff: ints 0..127
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def is_point(v):
+    return len(v) == 2 and type(v[0]) is int and type(v[1]) is int and 0 <= v[0] < 256 and 0 <= v[1] < 256
+
+def write_value(out, v):
+    if v is None:
+        out.append(T_NONE)
+    elif v is True:
+        out.append(T_TRUE)
+    elif v is False:
+        out.append(T_FALSE)
+    elif type(v) is int:
+        if 0 <= v < 128:
+            out.append(T_SMALL | v)
+        else:
+            out.append(T_INT)
+            write_varint(out, v * 2 if v >= 0 else -v * 2 - 1)
+    elif isinstance(v, float):
+        out.append(T_FLOAT)
+        out += FLOAT.pack(v)
+    elif isinstance(v, str):
+        idx = INTERN_INDEX.get(v)
+        if idx is not None:
+            out.append(T_INTERN | idx)
+        else:
+            b = v.encode()
+            out.append(T_STR)
+            write_varint(out, len(b))
+            out += b
+    elif isinstance(v, (list, tuple)):
+        if is_point(v):
+            out.append(T_POINT)
+            out.extend(v)
+        elif v and all(isinstance(p, (list, tuple)) and is_point(p) for p in v):
+            # snake bodies: a run of packed (x, y) byte pairs
+            out.append(T_POINTS)
+            write_varint(out, len(v))
+            for p in v:
+                out.extend(p)
+        else:
+            out.append(T_LIST)
+            write_varint(out, len(v))
+            for item in v:
+                write_value(out, item)
+    elif isinstance(v, dict):
+        out.append(T_DICT)
+        write_varint(out, len(v))
+        for k, item in v.items():
+            write_value(out, k)
+            write_value(out, item)
+    else:
+        raise TypeError(f"cannot encode {type(v).__name__}")
+
+def read_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag >= T_SMALL:
+        return tag - T_SMALL, pos
+    if tag >= T_INTERN:
+        return INTERNED[tag - T_INTERN], pos
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_INT:
+        n, pos = read_varint(buf, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == T_FLOAT:
+        return FLOAT.unpack_from(buf, pos)[0], pos + FLOAT.size
+    if tag == T_STR:
+        n, pos = read_varint(buf, pos)
+        return bytes(buf[pos:pos+n]).decode(), pos + n
+    if tag == T_POINT:
+        return [buf[pos], buf[pos+1]], pos + 2
+    if tag == T_POINTS:
+        n, pos = read_varint(buf, pos)
+        return [[buf[i], buf[i+1]] for i in range(pos, pos + 2*n, 2)], pos + 2*n
+    if tag == T_LIST:
+        n, pos = read_varint(buf, pos)
+        items = []
+        for _ in range(n):
+            item, pos = read_value(buf, pos)
+            items.append(item)
+        return items, pos
+    if tag == T_DICT:
+        n, pos = read_varint(buf, pos)
+        d = {}
+        for _ in range(n):
+            k, pos = read_value(buf, pos)
+            item, pos = read_value(buf, pos)
+            # same keys json would produce, so callers don't care about the format
+            d[k if type(k) is str else json.dumps(k)] = item
+        return d, pos
+    raise ValueError(f"unknown tag {tag}")
+
+def encode_msg(msg, fmt=FORMAT_JSON):
+    if fmt == FORMAT_JSON:
+        return (json.dumps(msg) + '\n').encode()
+    code = MSG_CODES.get(msg['id'], 0)
+    out = bytearray(HEADER.size)
+    write_value(out, {k: v for k, v in msg.items() if k != 'id'} if code else msg)
+    HEADER.pack_into(out, 0, len(out) - 4, code)
+    return bytes(out)
+
+def decode_payload(buf, pos, code):
+    msg, _ = read_value(buf, pos)
+    if code:
+        msg['id'] = MSG_NAMES[code]
+    return msg
+
+def decode_json(data):
+    try:
+        return json.loads(data)
+    except RecursionError:
+        # nested deeper than the interpreter can follow, as malformed as any other
+        raise ValueError("message nested too deeply")
+
+def decode_msg(data, fmt=FORMAT_JSON):
+    # a single complete message, raises ValueError when it isn't one
+    if fmt == FORMAT_JSON:
+        return decode_json(data)
+    if len(data) < HEADER.size:
+        raise ValueError("short frame")
+    length, code = HEADER.unpack_from(data)
+    if length + 4 != len(data):
+        raise ValueError("truncated frame")
+    try:
+        return decode_payload(data, HEADER.size, code)
+    except (IndexError, KeyError, TypeError, UnicodeDecodeError, RecursionError) as e:
+        raise ValueError(f"bad frame: {e}")
+
+class MessageReader:
+    # accumulates received bytes and splits them into messages, fmt can be
+    # switched between messages (after login). Data is received straight into
+    # one buffer and messages are decoded in place: a read offset moves past
+    # each message and leftovers are only moved to the front to make room.
+    def __init__(self, fmt=FORMAT_JSON, size=RECV_BUFFER):
+        self.fmt = fmt
+        self.buffer = bytearray(size)
+        self.start = 0  # first unread byte
+        self.end = 0    # end of received data
+        self.need = 0   # bytes still missing from a frame whose header has arrived
+
+    def reserve(self, n):
+        # makes room for n more bytes after end
+        if len(self.buffer) - self.end >= n:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buffer) - self.end < n:
+            self.buffer += bytes(max(n, len(self.buffer)))
+
+    def writable(self):
+        # free space for the next read, sized for the frame in progress if its length is known
+        self.reserve(max(RECV_BUFFER // 4, self.need))
+        return memoryview(self.buffer)[self.end:]
+
+    def written(self, n):
+        self.end += n
+
+    def recv_into(self, sock):
+        # one recv straight into the buffer, returns the byte count (0 at EOF)
+        with self.writable() as view:
+            n = sock.recv_into(view)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_message(self):
+        # returns None when no complete message is buffered,
+        # raises ValueError for a malformed one (which is dropped)
+        while True:
+            start, end = self.start, self.end
+            if start == end:
+                # everything consumed, start over at the front for free
+                self.start = self.end = 0
+                return None
+            if self.fmt == FORMAT_JSON:
+                i = self.buffer.find(b'\n', start, end)
+                if i < 0:
+                    if end - start > MAX_MESSAGE:
+                        self.start = self.end = 0
+                        raise ValueError("message too long")
+                    return None
+                self.start = i + 1
+                line = self.buffer[start:i]
+                if not line.strip():
+                    continue
+                return decode_json(line)
+            if end - start < HEADER.size:
+                return None
+            length, code = HEADER.unpack_from(self.buffer, start)
+            if length > MAX_MESSAGE:
+                # the stream can't be resynchronised, callers close the connection
+                self.start = self.end = 0
+                raise ValueError(f"frame of {length} bytes")
+            frame_end = start + 4 + length
+            if end < frame_end:
+                self.need = frame_end - end
+                return None
+            self.need = 0
+            self.start = frame_end
+            try:
+                return decode_payload(self.buffer, start + HEADER.size, code)
+            except (IndexError, KeyError, TypeError, UnicodeDecodeError, RecursionError) as e:
+                raise ValueError(f"bad frame: {e}")
@@ -0,0 +1,152 @@
+# render.py
+# In-game drawing for the client. Sprites and text are rendered once and reused;
+# each frame only the rectangles whose content changed are repainted and pushed
+# to the display. Snakes slide between the last two server ticks, so motion is
+# smooth at RENDER_FPS while the game itself only advances at FPS.
+import pygame
+from config import FPS
+
+CELL_SIZE = 32
+BACKGROUND = (5, 5, 25)
+SEGMENT_COLORS = [
+    (0,200,0),
+    (240,200,0),
+    (0,120,255),
+]
+
+def stacked(items):
+    # (surface, position, how many earlier items share that position)
+    depth = {}
+    for surf, pos in items:
+        n = depth[pos] = depth.get(pos, -1) + 1
+        yield surf, pos, n
+
+class Renderer:
+    def __init__(self, screen, font):
+        self.screen = screen
+        self.font = font
+        self.segments = []
+        for color in SEGMENT_COLORS:
+            surf = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+            pygame.draw.rect(surf, color, surf.get_rect(), border_radius=6)
+            self.segments.append(surf)
+        # our own head gets a white frame 3px larger than the cell on every side
+        self.head_frame = pygame.Surface((CELL_SIZE+6, CELL_SIZE+6), pygame.SRCALPHA)
+        pygame.draw.rect(self.head_frame, (255,255,255), self.head_frame.get_rect(), 2, border_radius=8)
+        self.predicted = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+        pygame.draw.rect(self.predicted, (255,255,0), self.predicted.get_rect(), 2, border_radius=6)
+        self.fruit = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+        c = CELL_SIZE // 2
+        pygame.draw.circle(self.fruit, (220,0,0), (c, c), CELL_SIZE//2 - 4)
+        stem_rect = pygame.Rect(0,0,6,12)
+        stem_rect.center = (c, 6)
+        pygame.draw.rect(self.fruit, (0,180,0), stem_rect, border_radius=3)
+        self.texts = {}
+        self.hud_key = None
+        self.hud = None
+        self.drawn = None  # [(surface, pos)] of the frame on screen
+        self.camera = None
+
+    def text(self, text, color):
+        key = (text, color)
+        surf = self.texts.get(key)
+        if surf is None:
+            if len(self.texts) > 512:
+                self.texts.clear()
+            surf = self.texts[key] = self.font.render(text, True, color)
+        return surf
+
+    def hud_surface(self, scores, ids, my_id):
+        # rebuilt only when a score or the player list changes
+        key = (tuple(scores), tuple(ids), my_id)
+        if key == self.hud_key:
+            return self.hud
+        players = [(cid, scores[slot] or 0) for slot, cid in enumerate(ids) if cid is not None]
+        lines = []
+        y = 6
+        for cid, score in players:
+            lines.append((self.text(f"Player {cid} points: {score}", (255,255,255)), y))
+            y += 22
+        # show other players info under HUD
+        if players:
+            y += 6
+            lines.append((self.text('Other players:', (200,200,200)), y))
+            y += 20
+            for cid, score in players:
+                # skip self
+                if cid == my_id:
+                    continue
+                lines.append((self.text(f"{cid} — {score} pts", (220,220,220)), y))
+                y += 18
+        width = max((surf.get_width() for surf, _ in lines), default=0)
+        height = max((y + surf.get_height() for surf, y in lines), default=0)
+        hud = pygame.Surface((width + 6, height), pygame.SRCALPHA)
+        for surf, y in lines:
+            hud.blit(surf, (6, y))
+        self.hud_key = key
+        self.hud = hud
+        return hud
+
+    def interpolated(self, prev, body, alpha):
+        # each segment moves from where it was a tick ago to where it is now,
+        # new segments (growth) come out of the old tail, jumps are not smoothed
+        if not prev or alpha >= 1:
+            return body
+        points = []
+        for i, (x, y) in enumerate(body):
+            px, py = prev[i] if i < len(prev) else prev[-1]
+            if abs(x - px) + abs(y - py) > 1:
+                return body
+            points.append((px + (x - px) * alpha, py + (y - py) * alpha))
+        return points
+
+    def items(self, client, camera, now):
+        # everything to draw this frame, back to front, as (surface, pixel position)
+        cam_x, cam_y = camera
+        # one read of the published worlds, the receive thread may swap in the next any time
+        prev, world, arrived = client.snapshots
+        alpha = min(1.0, (now - arrived) * FPS)
+        items = []
+        if world.fruit:
+            items.append((self.fruit, ((world.fruit[0]-cam_x)*CELL_SIZE, (world.fruit[1]-cam_y)*CELL_SIZE)))
+        for slot, body in enumerate(world.snakes):
+            if body is None:
+                continue
+            cid = world.ids[slot]
+            # a slot can change hands between ticks, only the same player is interpolated
+            same = slot < len(prev.ids) and prev.ids[slot] == cid
+            points = self.interpolated(prev.snakes[slot] if same else None, body, alpha)
+            for idx, (x, y) in enumerate(points):
+                pos = (round((x-cam_x)*CELL_SIZE), round((y-cam_y)*CELL_SIZE))
+                items.append((self.segments[idx % len(self.segments)], pos))
+                if idx == 0 and cid == client.my_id:
+                    items.append((self.head_frame, (pos[0]-3, pos[1]-3)))
+        if client.instant_move and client.predicted_body:
+            for x, y in client.predicted_body:
+                items.append((self.predicted, ((x-cam_x)*CELL_SIZE, (y-cam_y)*CELL_SIZE)))
+        items.append((self.hud_surface(world.scores, world.ids, client.my_id), (0, 0)))
+        return items
+
+    def draw(self, client, camera, now):
+        items = self.items(client, camera, now)
+        if self.drawn is None or camera != self.camera:
+            # first frame or the view scrolled: everything moves
+            self.screen.fill(BACKGROUND)
+            self.screen.blits(items, doreturn=False)
+            pygame.display.flip()
+        else:
+            # items stacked on the same spot count as changed when their order does
+            old = set(stacked(self.drawn))
+            new = set(stacked(items))
+            dirty = [surf.get_rect(topleft=pos) for surf, pos, _ in old ^ new]
+            if dirty:
+                rects = [surf.get_rect(topleft=pos) for surf, pos in items]
+                for area in dirty:
+                    # clear the area and repaint, in order, whatever overlaps it
+                    self.screen.set_clip(area)
+                    self.screen.fill(BACKGROUND)
+                    self.screen.blits([items[i] for i in area.collidelistall(rects)], doreturn=False)
+                self.screen.set_clip(None)
+                pygame.display.update(dirty)
+        self.drawn = items
+        self.camera = camera
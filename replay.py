@@ -0,0 +1,202 @@
+# replay.py
+# Plays back a match recorded with REPLAY_DIR set. The room is re-simulated from
+# its seed and recorded commands with nothing sent anywhere, so ticks run back to
+# back instead of at FPS. Every keyframe in the log is checked on the way, a
+# mismatch means the simulation no longer behaves the way it did when recorded.
+#
+#   python3 replay.py LOG                    fast-forward through the match and verify it
+#   python3 replay.py LOG --seek 1200        show the state at tick 1200
+#   python3 replay.py LOG --watch --speed 4  spectate (from --seek) at 4x FPS
+import argparse
+import bisect
+import time
+from collections import deque
+from config import FPS
+from replaylog import REPLAY_VERSION, R_HEADER, R_TICK, R_KEYFRAME, R_END, COMMANDS, rules, pack, read_records, snapshot, restore_rng
+from server import GameRoom, Snake
+
+class ReplayRoom(GameRoom):
+    # nobody to send to, update() only simulates
+    def __init__(self, seed, size):
+        super().__init__(0, size, seed)
+
+    def send_world(self, events):
+        pass
+
+class Replay:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.commands = {}   # tick -> [[command index, args...], ...]
+        self.keyframes = []  # (tick, state) in tick order, state as written by snapshot()
+        self.end = None
+        records = read_records(data)
+        kind, header = next(records, (None, None))
+        if kind != R_HEADER or header[0] != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay log")
+        _, self.seed, size, self.rules = header
+        self.size = tuple(size)
+        for kind, value in records:
+            if kind == R_TICK:
+                self.commands[value[0]] = value[1:]
+            elif kind == R_KEYFRAME:
+                self.keyframes.append((value[0], value))
+            elif kind == R_END:
+                self.end = value[0]
+        if self.end is None:
+            # the server stopped before the room closed, play what was written
+            self.end = max([tick + 1 for tick in self.commands] + [tick for tick, _ in self.keyframes] + [0])
+        self.keyframe_ticks = [tick for tick, _ in self.keyframes]
+
+    def restore(self, state):
+        tick, rng, fruit, ids, snakes, free = state
+        room = ReplayRoom(self.seed, self.size)
+        restore_rng(room.rng, rng)
+        room.tick = tick
+        room.fruit = tuple(fruit) if fruit else None
+        room.ids = list(ids)
+        room.snakes = [None] * len(ids)
+        for slot, cid in enumerate(ids):
+            if cid is None:
+                continue
+            body, direction, score, alive, last_input, growth, inputs, queued_seq, acked = snakes[slot]
+            snake = Snake((0, 0), direction)
+            snake.body = deque(tuple(p) for p in body)
+            snake.score, snake.alive, snake.last_input, snake.growth = score, alive, last_input, growth
+            snake.inputs.extend(tuple(item) for item in inputs)
+            snake.queued_seq, snake.acked = queued_seq, acked
+            room.add_snake(slot, snake)
+            room.slot_of[cid] = slot
+            room.clients[cid] = None
+            room.members.add(cid)
+        room.grid.set_free(free)
+        return room
+
+    def step(self, room):
+        # one tick with the commands recorded for it
+        for index, *args in self.commands.get(room.tick, ()):
+            name = COMMANDS[index]
+            if name == 'join':
+                args = (args[0], None)
+            room.commands.append((getattr(room, name), tuple(args)))
+        room.update()
+
+    def room_at(self, tick):
+        # the latest keyframe at or before tick, then fast-forward
+        tick = min(tick, self.end)
+        i = bisect.bisect_right(self.keyframe_ticks, tick) - 1
+        room = self.restore(self.keyframes[i][1]) if i >= 0 else ReplayRoom(self.seed, self.size)
+        while room.tick < tick:
+            self.step(room)
+        return room
+
+    def frames(self, start=0):
+        # the room after every tick from start to the end of the match
+        room = self.room_at(start)
+        while room.tick < self.end:
+            self.step(room)
+            yield room
+
+    def verify(self):
+        # plays the whole match, returns the first tick whose state differs from its
+        # keyframe. A room restored from each keyframe (what seeking plays from) runs
+        # alongside and has to arrive at the next keyframe and the end in the same state
+        expected = dict(self.keyframes)
+        room = ReplayRoom(self.seed, self.size)
+        seeked = None
+        while True:
+            state = expected.get(room.tick)
+            if state is not None or room.tick >= self.end:
+                current = pack(R_KEYFRAME, snapshot(room))
+                if state is not None and current != pack(R_KEYFRAME, state):
+                    return room.tick
+                if seeked is not None and pack(R_KEYFRAME, snapshot(seeked)) != current:
+                    return room.tick
+                if state is not None:
+                    seeked = self.restore(state)
+            if room.tick >= self.end:
+                return None
+            self.step(room)
+            if seeked is not None:
+                self.step(seeked)
+
+def describe(room):
+    lines = [f"tick {room.tick}, fruit {room.fruit}"]
+    for slot, snake in enumerate(room.snakes):
+        if snake is not None:
+            state = 'alive' if snake.alive else 'dead'
+            lines.append(f"  player {room.ids[slot]}: {snake.score} points, {len(snake.body)} long, head {snake.body[0]}, {state}")
+    return '\n'.join(lines)
+
+class Spectator:
+    # the parts of SnakeClient the Renderer reads
+    def __init__(self):
+        from client import EMPTY_WORLD
+        self.my_id = None
+        self.instant_move = False
+        self.predicted_body = None
+        self.world = EMPTY_WORLD
+        self.snapshots = (EMPTY_WORLD, EMPTY_WORLD, time.time())
+
+    def show(self, room):
+        from client import World
+        msg = room.keyframe_msg()
+        world = World(msg['tick'], msg['snakes'], msg['fruit'], msg['scores'], msg['ids'], msg['acks'])
+        self.snapshots = (self.world, world, time.time())
+        self.world = world
+
+def watch(replay, start=0, speed=1.0):
+    import pygame
+    from render import CELL_SIZE, Renderer
+    pygame.init()
+    screen = pygame.display.set_mode((replay.size[0]*CELL_SIZE, replay.size[1]*CELL_SIZE))
+    pygame.display.set_caption('replay')
+    renderer = Renderer(screen, pygame.font.SysFont('Courier', 22, bold=True))
+    spectator = Spectator()
+    spectator.show(replay.room_at(start))
+    clock = pygame.time.Clock()
+    frames = replay.frames(start)
+    next_tick = time.time()
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return
+        now = time.time()
+        if now >= next_tick:
+            room = next(frames, None)
+            if room is None:
+                pygame.quit()
+                return
+            spectator.show(room)
+            next_tick = now + 1 / (FPS * speed)
+        renderer.draw(spectator, (0, 0), now)
+        clock.tick(60)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded match')
+    parser.add_argument('log')
+    parser.add_argument('--seek', type=int, default=None, help='tick to jump to')
+    parser.add_argument('--watch', action='store_true', help='draw the match instead of fast-forwarding')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed while watching, 1 = FPS')
+    args = parser.parse_args()
+    replay = Replay(args.log)
+    if replay.rules != rules():
+        print(f"recorded with rules {replay.rules}, config now has {rules()}: expect the replay to diverge")
+    if args.watch:
+        watch(replay, args.seek or 0, args.speed)
+    elif args.seek is not None:
+        started = time.perf_counter()
+        room = replay.room_at(args.seek)
+        print(describe(room))
+        print(f"seek took {(time.perf_counter() - started)*1000:.1f} ms")
+    else:
+        started = time.perf_counter()
+        diverged = replay.verify()
+        elapsed = time.perf_counter() - started
+        if diverged is not None:
+            print(f"diverged from the recording or a seek at tick {diverged}")
+        else:
+            print(describe(replay.room_at(replay.end)))
+            print(f"{replay.end} ticks in {elapsed:.2f} s, {replay.end / max(elapsed, 1e-9) / FPS:.0f}x real time, "
+                  f"{len(replay.keyframes)} keyframes verified")
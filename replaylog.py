@@ -0,0 +1,94 @@
+# replaylog.py
+# Match recordings. A room's simulation depends only on its seed and on the
+# commands (join, leave, turn) applied at the start of each tick, so that is all
+# a log holds, plus the full room state every REPLAY_KEYFRAME_INTERVAL ticks so
+# replay.py can seek without re-simulating from the start.
+#
+# The log is append-only, one record per frame: [u32 length][u8 kind][value],
+# the value in protocol.py's tagged binary encoding. Ticks without commands
+# write nothing.
+from config import SNAKE_LEN, INPUT_BUFFER, WIN_SCORE, BODY_COLLISIONS, REPLAY_KEYFRAME_INTERVAL
+from protocol import HEADER, write_value, read_value
+
+REPLAY_VERSION = 2
+R_HEADER, R_TICK, R_KEYFRAME, R_END = range(1, 5)
+
+# recorded commands are [index, args...], the index into this tuple
+COMMANDS = ('join', 'leave', 'turn')
+
+def rules():
+    # settings the simulation depends on besides the seed and board size
+    return [SNAKE_LEN, INPUT_BUFFER, WIN_SCORE, BODY_COLLISIONS]
+
+def pack(kind, value):
+    out = bytearray(HEADER.size)
+    write_value(out, value)
+    HEADER.pack_into(out, 0, len(out) - 4, kind)
+    return bytes(out)
+
+def read_records(data):
+    # (kind, value) for every complete record, a cut off last one is ignored
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        length, kind = HEADER.unpack_from(data, pos)
+        end = pos + 4 + length
+        if end > len(data):
+            return
+        value, _ = read_value(data, pos + HEADER.size)
+        yield kind, value
+        pos = end
+
+def snapshot(room):
+    # everything update() reads, as plain lists: [tick, rng state, fruit, ids, snakes, free cells].
+    # The free cell list is kept in its shuffled order, fruit is placed by index into it
+    version, internal, gauss = room.rng.getstate()
+    snakes = []
+    for snake in room.snakes:
+        if snake is None:
+            snakes.append(None)
+            continue
+        snakes.append([list(snake.body), snake.direction, snake.score, snake.alive, snake.last_input,
+                       snake.growth, [list(item) for item in snake.inputs], snake.queued_seq, snake.acked])
+    return [room.tick, [version, list(internal), gauss], room.fruit, list(room.ids), snakes, list(room.grid.free)]
+
+def restore_rng(rng, state):
+    version, internal, gauss = state
+    rng.setstate((version, tuple(internal), gauss))
+
+class ReplayRecorder:
+    # called from the room's tick thread only: tick_started() before each tick's
+    # commands run, command() for each of them, close() when the room ends
+    def __init__(self, path, room, interval=REPLAY_KEYFRAME_INTERVAL):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.interval = interval
+        self.tick = room.tick
+        self.pending = []
+        self.file.write(pack(R_HEADER, [REPLAY_VERSION, room.seed, list(room.size), rules()]))
+
+    def write_pending(self):
+        if self.pending:
+            self.file.write(pack(R_TICK, [self.tick] + self.pending))
+            self.pending = []
+
+    def tick_started(self, room):
+        self.write_pending()
+        self.tick = room.tick
+        if self.tick % self.interval == 0:
+            self.file.write(pack(R_KEYFRAME, snapshot(room)))
+            # a crash loses at most one interval
+            self.file.flush()
+
+    def command(self, name, args):
+        if name == 'join':
+            # the connection isn't part of the game
+            args = args[:1]
+        self.pending.append([COMMANDS.index(name)] + list(args))
+
+    def close(self, room):
+        try:
+            self.write_pending()
+            self.file.write(pack(R_KEYFRAME, snapshot(room)))
+            self.file.write(pack(R_END, [room.tick]))
+        finally:
+            self.file.close()
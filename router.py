@@ -0,0 +1,171 @@
+# router.py
+# Front door for a multi-process server: accepts connections and hands each socket
+# to one of several worker processes, each running its own GameServer with rooms.
+# Sockets are passed over a unix datagram pair (SCM_RIGHTS), so once routed a
+# client talks to its worker directly. Workers report their load back on the same pair.
+import socket
+import threading
+import time
+import json
+import asyncio
+import multiprocessing
+import os
+from config import HOST, PORT, LISTEN_BACKLOG, ROUTER_WORKERS, HEALTH_INTERVAL, METRICS_PORT, MSG_HEALTH
+from protocol import encode_msg
+from server import GameServer, ClientProtocol, raise_fd_limit
+
+HEALTH_TIMEOUT = HEALTH_INTERVAL * 3
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.process = multiprocessing.Process(target=worker_main, args=(index, child), daemon=True)
+        self.process.start()
+        child.close()
+        self.players = 0
+        self.rooms = 0
+        self.ticks = {}
+        # connections routed since the last report, so a burst doesn't all land on one worker
+        self.routed = 0
+        self.last_report = time.time()
+
+    def healthy(self):
+        return self.process.is_alive() and time.time() - self.last_report < HEALTH_TIMEOUT
+
+    def load(self):
+        return self.players + self.routed
+
+class Router:
+    def __init__(self, workers=ROUTER_WORKERS):
+        self.count = workers or os.cpu_count() or 1
+        self.workers = []
+        self.lock = threading.Lock()
+        self.running = True
+
+    def start_worker(self, index):
+        worker = Worker(index)
+        threading.Thread(target=self.watch_health, args=(worker,), daemon=True).start()
+        return worker
+
+    def watch_health(self, worker):
+        while self.running:
+            try:
+                data = worker.channel.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                continue
+            if msg.get('id') == MSG_HEALTH:
+                with self.lock:
+                    worker.players = msg['players']
+                    worker.rooms = msg['rooms']
+                    worker.ticks = msg.get('ticks', {})
+                    worker.routed = 0
+                    worker.last_report = time.time()
+
+    def monitor(self):
+        # replace workers whose process died
+        while self.running:
+            time.sleep(HEALTH_INTERVAL)
+            for i, worker in enumerate(self.workers):
+                if not worker.process.is_alive():
+                    print(f"Worker {i} exited ({worker.process.exitcode}), restarting")
+                    worker.channel.close()
+                    replacement = self.start_worker(i)
+                    with self.lock:
+                        self.workers[i] = replacement
+
+    def pick_worker(self):
+        with self.lock:
+            candidates = [w for w in self.workers if w.healthy()] or [w for w in self.workers if w.process.is_alive()]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda w: w.load())
+            worker.routed += 1
+            return worker
+
+    def route(self, conn):
+        worker = self.pick_worker()
+        try:
+            if worker is None:
+                print("No worker available, dropping connection")
+                return
+            socket.send_fds(worker.channel, [b'c'], [conn.fileno()])
+        except OSError as e:
+            print(f"Routing to worker {worker.index} failed: {e}")
+        finally:
+            # the worker holds its own copy of the descriptor now
+            conn.close()
+
+    def run(self):
+        raise_fd_limit()
+        self.workers = [self.start_worker(i) for i in range(self.count)]
+        threading.Thread(target=self.monitor, daemon=True).start()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((HOST, PORT))
+        s.listen(LISTEN_BACKLOG)
+        print(f"Router listening on {HOST}:{PORT} with {self.count} workers")
+        try:
+            while self.running:
+                conn, addr = s.accept()
+                self.route(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            s.close()
+
+def worker_main(index, channel):
+    raise_fd_limit()
+    server = GameServer()
+    try:
+        asyncio.run(serve_worker(server, index, channel))
+    except KeyboardInterrupt:
+        pass
+
+async def serve_worker(server, index, channel):
+    server.loop = asyncio.get_running_loop()
+    if METRICS_PORT:
+        server.start_metrics(METRICS_PORT + index)
+    channel.setblocking(False)
+    server.loop.add_reader(channel.fileno(), accept_routed, server, channel)
+    server.loop.create_task(report_health(server, index, channel))
+    print(f"Worker {index} ready (pid {os.getpid()})")
+    await server.game_loop_async()
+
+def accept_routed(server, channel):
+    try:
+        _, fds, _, _ = socket.recv_fds(channel, 16, 8)
+    except BlockingIOError:
+        return
+    except OSError:
+        # the router went away
+        server.running = False
+        return
+    for fd in fds:
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        server.loop.create_task(server.loop.connect_accepted_socket(lambda: ClientProtocol(server), sock))
+
+async def report_health(server, index, channel):
+    while server.running:
+        msg = {'id': MSG_HEALTH, 'worker': index, 'pid': os.getpid(),
+               'players': len(server.clients), 'rooms': len(server.rooms),
+               'ticks': server.tick_stats()}
+        try:
+            channel.send(encode_msg(msg))
+        except BlockingIOError:
+            pass
+        except OSError:
+            server.running = False
+            return
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+if __name__ == '__main__':
+    Router().run()
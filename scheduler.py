@@ -0,0 +1,82 @@
+# scheduler.py
+# Fixed-timestep tick clock. Tick n is due at start + n*period on the monotonic
+# clock, so the time update() takes is absorbed instead of stretching the period.
+import time
+from collections import deque
+from config import FPS, TICK_POLICY, MAX_CATCHUP_TICKS
+
+class TickStats:
+    def __init__(self, window=256):
+        self.ticks = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.overruns = 0   # update() took longer than a whole period
+        self.late = 0       # scheduler woke up one or more periods behind
+        self.skipped = 0    # ticks dropped instead of simulated
+        self.recent = deque(maxlen=window)
+
+    def record(self, duration, period):
+        self.ticks += 1
+        self.total += duration
+        self.last = duration
+        if duration > self.max:
+            self.max = duration
+        if duration > period:
+            self.overruns += 1
+        self.recent.append(duration)
+
+    def percentile(self, p):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def summary(self):
+        return {
+            'ticks': self.ticks,
+            'mean_ms': self.total / self.ticks * 1000 if self.ticks else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+            'overruns': self.overruns,
+            'late': self.late,
+            'skipped': self.skipped,
+        }
+
+class TickScheduler:
+    # policy 'catchup' runs missed ticks back to back (at most max_catchup per wakeup),
+    # 'skip' drops them and carries on from the current time
+    def __init__(self, rate=FPS, policy=TICK_POLICY, max_catchup=MAX_CATCHUP_TICKS):
+        self.period = 1 / rate
+        self.policy = policy
+        self.max_catchup = max_catchup
+        self.next_tick = None
+        self.stats = TickStats()
+
+    def delay(self):
+        # seconds until the next tick is due
+        if self.next_tick is None:
+            self.next_tick = time.monotonic()
+        return max(0.0, self.next_tick - time.monotonic())
+
+    def run_due(self, update):
+        # runs every tick that is due, returns how many ran
+        now = time.monotonic()
+        if self.next_tick is None:
+            self.next_tick = now
+        if now < self.next_tick:
+            return 0
+        due = int((now - self.next_tick) / self.period) + 1
+        count = due
+        if due > 1:
+            self.stats.late += 1
+            count = 1 if self.policy == 'skip' else min(due, self.max_catchup)
+            self.stats.skipped += due - count
+            self.next_tick += (due - count) * self.period
+        for _ in range(count):
+            start = time.perf_counter()
+            update()
+            self.stats.record(time.perf_counter() - start, self.period)
+            self.next_tick += self.period
+        return count
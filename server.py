@@ -1,13 +1,27 @@
+import os
 import socket
 import threading
 import time
 import random
-import json
-from config import HOST, PORT, LOGIN_KEY, FPS, GAME_SIZE, SNAKE_LEN, WIN_SCORE, MSG_LOGIN, MSG_LOGIN_RESP, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_PING, MSG_PONG, MSG_DISCONNECT, DIRS
+import asyncio
+import itertools
+import functools
+from array import array
+from collections import deque
+from config import HOST, PORT, LOGIN_KEY, FPS, GAME_SIZE, VIEW_SIZE, AOI_BUCKET, SNAKE_LEN, INPUT_BUFFER, WIN_SCORE, BODY_COLLISIONS, ROOM_SIZE, SERVER_MODE, LISTEN_BACKLOG, OUTBOUND_HIGH_WATER, MAX_OUTBOUND_BYTES, MAX_DROPPED_SNAPSHOTS, DELTA_UPDATES, KEYFRAME_INTERVAL, UDP_ENABLED, MAX_DATAGRAM, REPLAY_DIR, METRICS_PORT, MSG_LOGIN, MSG_LOGIN_RESP, MSG_START, MSG_INPUT, MSG_UPDATE, MSG_DELTA, MSG_PING, MSG_PONG, MSG_DISCONNECT, MSG_WIN, MSG_LOSE, DIRS
+from protocol import FORMAT_JSON, FORMATS, MessageReader, encode_msg, decode_msg
+from scheduler import TickScheduler
+from replaylog import ReplayRecorder
+from metrics import Metrics, TimedLock, serve_metrics
+
+OPPOSITES = {('UP','DOWN'),('DOWN','UP'),('LEFT','RIGHT'),('RIGHT','LEFT')}
 
 class Snake:
+    # body is a deque with the head at index 0, so a step is O(1) whatever the length
+    __slots__ = ('body', 'direction', 'score', 'alive', 'last_input', 'growth', 'inputs', 'queued_seq', 'acked')
+
     def __init__(self, start_pos, direction):
-        self.body = [start_pos]
+        self.body = deque([start_pos])
         self.direction = direction
         for _ in range(SNAKE_LEN-1):
             x, y = self.body[-1]
@@ -16,13 +30,48 @@ class Snake:
         self.score = 0
         self.alive = True
         self.last_input = direction
+        self.growth = 0
+        # turns waiting to be applied, one per tick, as (seq, direction)
+        self.inputs = deque(maxlen=INPUT_BUFFER)
+        self.queued_seq = 0
+        self.acked = 0
 
     def move(self, direction=None):
+        # returns the tail cell that was freed, None while growing
         if direction:
             self.last_input = direction
         dx, dy = DIRS[self.last_input]
-        head = (self.body[0][0]+dx, self.body[0][1]+dy)
-        self.body = [head] + self.body[:-1]
+        head = self.body[0]
+        self.body.appendleft((head[0]+dx, head[1]+dy))
+        if self.growth:
+            self.growth -= 1
+            return None
+        return self.body.pop()
+
+    def queue_input(self, direction, seq=None):
+        # seq comes from the client; resent or stale inputs are ignored
+        if seq is not None:
+            if seq <= self.queued_seq:
+                return
+            self.queued_seq = seq
+        self.inputs.append((seq, direction))
+
+    def apply_input(self):
+        if not self.inputs:
+            return
+        seq, desired = self.inputs.popleft()
+        # prevent 180-degree turns
+        if (self.last_input, desired) not in OPPOSITES:
+            self.last_input = desired
+        if seq is not None:
+            self.acked = seq
+
+    def grow(self, segments=1):
+        self.growth += segments
+
+    def body_list(self):
+        # the list of [x, y] pairs MSG_UPDATE carries
+        return list(self.body)
 
     def check_collision(self, game_size):
         x, y = self.body[0]
@@ -35,160 +84,1056 @@ class Snake:
             return True
         return False
 
-class GameServer:
+class OccupancyGrid:
+    # segment count per cell, kept up to date as snakes move, plus an index of
+    # free cells (swap-remove) so fruit placement never has to search the board.
+    # With a bucket size it also tracks which snakes have segments in each
+    # bucket x bucket block, so a view can be filled without scanning every snake.
+    def __init__(self, size, bucket=None):
+        self.width, self.height = size
+        cells = self.width * self.height
+        self.counts = array('H', bytes(2 * cells))
+        self.free = list(range(cells))
+        self.free_at = list(range(cells))
+        # last tick a head was placed on each cell and by whom, for head-on checks
+        self.head_tick = array('q', [-1]) * cells
+        self.head_owner = [None] * cells
+        self.bucket = bucket
+        if bucket:
+            self.bucket_cols = (self.width + bucket - 1) // bucket
+            rows = (self.height + bucket - 1) // bucket
+            self.buckets = [{} for _ in range(self.bucket_cols * rows)]  # owner -> segments
+
+    def index(self, pos):
+        x, y = pos
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return -1
+
+    def bucket_at(self, pos):
+        return self.buckets[pos[1] // self.bucket * self.bucket_cols + pos[0] // self.bucket]
+
+    def add(self, pos, owner=None):
+        i = self.index(pos)
+        if i < 0:
+            return
+        if self.bucket and owner is not None:
+            owners = self.bucket_at(pos)
+            owners[owner] = owners.get(owner, 0) + 1
+        if self.counts[i] == 0:
+            last = self.free.pop()
+            if last != i:
+                slot = self.free_at[i]
+                self.free[slot] = last
+                self.free_at[last] = slot
+            self.free_at[i] = -1
+        self.counts[i] += 1
+
+    def remove(self, pos, owner=None):
+        i = self.index(pos)
+        if i < 0:
+            return
+        if self.bucket and owner is not None:
+            owners = self.bucket_at(pos)
+            owners[owner] -= 1
+            if not owners[owner]:
+                del owners[owner]
+        self.counts[i] -= 1
+        if self.counts[i] == 0:
+            self.free_at[i] = len(self.free)
+            self.free.append(i)
+
+    def count(self, pos):
+        i = self.index(pos)
+        return self.counts[i] if i >= 0 else 0
+
+    def owners_in(self, rect):
+        # snakes with a segment in a bucket touching rect (x0, y0, x1, y1), end exclusive
+        x0, y0, x1, y1 = rect
+        found = set()
+        for by in range(y0 // self.bucket, (y1 - 1) // self.bucket + 1):
+            row = by * self.bucket_cols
+            for bx in range(x0 // self.bucket, (x1 - 1) // self.bucket + 1):
+                found.update(self.buckets[row + bx])
+        return found
+
+    def set_free(self, free):
+        # takes over another grid's free cells in their order, which decides where random_free() lands
+        self.free = list(free)
+        self.free_at = [-1] * len(self.free_at)
+        for slot, i in enumerate(self.free):
+            self.free_at[i] = slot
+
+    def random_free(self, rng=random):
+        if not self.free:
+            return None
+        i = self.free[rng.randrange(len(self.free))]
+        return (i % self.width, i // self.width)
+
+    def claim_head(self, pos, tick, owner):
+        # returns the owner of another head already on this cell this tick
+        i = self.index(pos)
+        if i < 0:
+            return None
+        if self.head_tick[i] == tick:
+            return self.head_owner[i]
+        self.head_tick[i] = tick
+        self.head_owner[i] = owner
+        return None
+
+PONG_BYTES = {fmt: encode_msg({'id': MSG_PONG}, fmt) for fmt in FORMATS}
+
+class Batch:
+    # messages written together, encoded at most once per wire format
+    def __init__(self, msgs):
+        self.msgs = msgs
+        self.data = {}
+
+    def encoded(self, fmt):
+        if fmt not in self.data:
+            self.data[fmt] = b''.join(encode_msg(msg, fmt) for msg in self.msgs)
+        return self.data[fmt]
+
+class OutboundQueue:
+    # unsent data for one client. Events are delivered in order; of the world
+    # snapshots only the newest is kept, and after a drop the next one has to be a
+    # keyframe since the client can't apply a delta against a state it never got.
     def __init__(self):
+        self.items = deque()  # (data, is_snapshot)
+        self.bytes = 0
+        self.has_snapshot = False
+        self.dropped = 0  # snapshots dropped since the queue last drained
+
+    def push(self, data):
+        if data:
+            self.items.append((data, False))
+            self.bytes += len(data)
+
+    def push_snapshot(self, data, keyframe):
+        # returns False when the delta was refused and a keyframe is needed instead
+        if self.has_snapshot:
+            self.items = deque(item for item in self.items if not item[1])
+            self.bytes = sum(len(item[0]) for item in self.items)
+            self.has_snapshot = False
+            self.dropped += 1
+            if not keyframe:
+                return False
+        self.items.append((data, True))
+        self.bytes += len(data)
+        self.has_snapshot = True
+        return True
+
+    def take(self):
+        # everything queued, as one write
+        data = b''.join(item[0] for item in self.items)
+        self.items.clear()
+        self.bytes = 0
+        self.has_snapshot = False
+        self.dropped = 0
+        return data
+
+    def overloaded(self):
+        return self.bytes > MAX_OUTBOUND_BYTES or self.dropped > MAX_DROPPED_SNAPSHOTS
+
+class AsyncConnection:
+    # writes go straight to the transport until asyncio reports its buffer is over
+    # the high-water mark, then queue up until resume_writing()
+    def __init__(self, transport):
+        self.transport = transport
+        self.queue = OutboundQueue()
+        self.paused = False
+        self.udp = None
+        self.udp_addr = None
+        # handed to this connection, queued or written
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, data):
+        self.bytes_sent += len(data)
+        if self.paused:
+            self.queue.push(data)
+            self.check_backlog()
+        else:
+            self.transport.write(data)
+        return len(data)
+
+    def send_snapshot(self, data, keyframe, prefix=b''):
+        # prefix holds this tick's events, which are never dropped
+        if not self.paused:
+            self.transport.write(prefix + data if prefix else data)
+            self.bytes_sent += len(prefix) + len(data)
+            return True
+        self.queue.push(prefix)
+        ok = self.queue.push_snapshot(data, keyframe)
+        self.bytes_sent += len(prefix) + (len(data) if ok else 0)
+        self.check_backlog()
+        return ok
+
+    def bind_udp(self, udp, addr):
+        self.udp = udp
+        self.udp_addr = addr
+
+    def send_datagram(self, data):
+        self.udp.sendto(data, self.udp_addr)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        data = self.queue.take()
+        if data:
+            self.transport.write(data)
+
+    def check_backlog(self):
+        if self.queue.overloaded():
+            print(f"Dropping slow client {self.transport.get_extra_info('peername')}")
+            self.transport.abort()
+
+    def close(self):
+        data = self.queue.take()
+        if data:
+            self.transport.write(data)
+        self.transport.close()
+
+class SocketConnection:
+    # threaded mode: callers only queue, a writer thread per client does the
+    # blocking sends, so one stalled client never holds up a room's tick
+    def __init__(self, sock):
+        self.sock = sock
+        self.addr = sock.getpeername()
+        self.queue = OutboundQueue()
+        self.cond = threading.Condition()
+        self.closing = False
+        self.closed = False
+        self.udp = None
+        self.udp_addr = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def send(self, data):
+        self.bytes_sent += len(data)
+        with self.cond:
+            self.queue.push(data)
+            self.cond.notify()
+        self.check_backlog()
+        return len(data)
+
+    def send_snapshot(self, data, keyframe, prefix=b''):
+        with self.cond:
+            self.queue.push(prefix)
+            ok = self.queue.push_snapshot(data, keyframe)
+            self.cond.notify()
+        self.bytes_sent += len(prefix) + (len(data) if ok else 0)
+        self.check_backlog()
+        return ok
+
+    def bind_udp(self, udp, addr):
+        self.udp = udp
+        self.udp_addr = addr
+
+    def send_datagram(self, data):
+        self.udp.sendto(data, self.udp_addr)
+
+    def writer(self):
+        while True:
+            with self.cond:
+                while not self.queue.items and not self.closing and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                data = self.queue.take()
+                done = self.closing and not data
+            if done:
+                self.abort()
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.abort()
+                return
+
+    def check_backlog(self):
+        if self.queue.overloaded():
+            print(f"Dropping slow client {self.addr}")
+            self.abort()
+
+    def close(self):
+        # flush what's queued, then close
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+
+    def abort(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    # the event loop reads straight into the reader's buffer
+    def __init__(self, server):
+        self.server = server
+        self.reader = MessageReader()
+        self.conn = None
+        self.client_id = None
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=OUTBOUND_HIGH_WATER)
+        self.conn = AsyncConnection(transport)
+        self.client_id = self.server.new_client_id()
+
+    def pause_writing(self):
+        self.conn.pause()
+
+    def resume_writing(self):
+        self.conn.resume()
+
+    def get_buffer(self, sizehint):
+        return self.reader.writable()
+
+    def buffer_updated(self, nbytes):
+        self.reader.written(nbytes)
+        self.conn.bytes_received += nbytes
+        try:
+            while True:
+                msg = self.reader.next_message()
+                if msg is None:
+                    break
+                if not self.server.handle_message(self.client_id, self.conn, msg):
+                    self.conn.close()
+                    return
+                self.reader.fmt = self.server.formats.get(self.client_id, FORMAT_JSON)
+        except Exception as e:
+            print(f"Client {self.client_id} error: {e}")
+            self.conn.close()
+
+    def connection_lost(self, exc):
+        self.server.remove_client(self.client_id)
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+def pairs(values):
+    # {slot: value} as the flat [slot, value, slot, value, ...] list deltas carry
+    return [item for slot_value in values.items() for item in slot_value]
+
+class GameRoom:
+    # one match: its own board, fruit, players and tick loop. A player gets the
+    # lowest free slot; snakes and player ids are lists indexed by slot and go
+    # out on the wire the same way.
+    def __init__(self, room_id, size=GAME_SIZE, seed=None, metrics=None):
+        self.room_id = room_id
+        # wire format per player, the room's own copy: the server forgets a client
+        # as soon as it disconnects, the room only once the leave command has run
+        self.formats = {}
+        self.size = size
+        # all randomness in a match comes from here, so a seed and the commands replay it
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.recorder = None
+        self.metrics = metrics if metrics is not None else Metrics()
         self.clients = {}
-        self.snakes = {}
-        self.player_numbers = {}
-        self.next_player_num = 1
+        self.slot_of = {}
+        self.ids = []     # slot -> client id, None when free
+        self.snakes = []  # slot -> Snake, None when free
         self.fruit = None
-        self.lock = threading.Lock()
         self.running = True
-        self.last_ping = {}
+        # game state belongs to the tick thread; other threads only append to
+        # commands (deque appends are atomic), which update() applies first
+        self.commands = deque()
+        self.members = set()  # players assigned here, including joins not applied yet
+        self.grid = OccupancyGrid(size, AOI_BUCKET if VIEW_SIZE else None)
+        self.scheduler = TickScheduler()
+        self.bytes_sent = 0
+        self.pending_events = []
+        self.tick = 0
+        # state as last sent to clients, the base for the next delta:
+        # slot -> (client id, head, length, score, acked)
+        self.sent_snakes = None
+        self.sent_fruit = None
+        self.needs_keyframe = set()
+        # with VIEW_SIZE: per client, the slots and fruit it was last sent
+        self.client_views = {}
+
+    def is_open(self):
+        return self.running and len(self.members) < ROOM_SIZE
 
     def spawn_fruit(self):
-        while True:
-            pos = (random.randint(0, GAME_SIZE[0]-1), random.randint(0, GAME_SIZE[1]-1))
-            if all(pos not in snake.body for snake in self.snakes.values()):
-                return pos
-
-    def handle_client(self, conn, addr):
-        client_id = addr[1]
-        buffer = ''
-        logged_in = False
+        # None when the board is full
+        return self.grid.random_free(self.rng)
+
+    def free_slot(self):
+        if None in self.ids:
+            return self.ids.index(None)
+        self.ids.append(None)
+        self.snakes.append(None)
+        return len(self.ids) - 1
+
+    def add_snake(self, slot, snake):
+        self.snakes[slot] = snake
+        for pos in snake.body:
+            self.grid.add(pos, slot)
+
+    def drop_snake(self, slot):
+        for pos in self.snakes[slot].body:
+            self.grid.remove(pos, slot)
+        self.snakes[slot] = None
+
+    # called from network threads
+    def add_player(self, cid, conn, fmt=FORMAT_JSON):
+        self.members.add(cid)
+        self.commands.append((self.join, (cid, conn, fmt)))
+
+    def remove_player(self, cid, notify=False):
+        self.members.discard(cid)
+        if not self.members:
+            self.running = False
+        self.commands.append((self.leave, (cid, notify)))
+
+    def steer(self, cid, desired, seq=None):
+        # checked here, on the sender's thread: a bad input raising on the tick
+        # thread would stop the room for everyone in it
+        if isinstance(desired, str) and desired in DIRS and (seq is None or type(seq) is int):
+            self.commands.append((self.turn, (cid, desired, seq)))
+
+    # tick thread
+    def run_commands(self):
+        while self.commands:
+            command, args = self.commands.popleft()
+            if self.recorder is not None:
+                self.recorder.command(command.__name__, args)
+            command(*args)
+
+    def join(self, cid, conn, fmt=FORMAT_JSON):
+        if cid in self.slot_of:
+            # one snake per player
+            return
+        slot = self.free_slot()
+        self.clients[cid] = conn
+        self.formats[cid] = fmt
+        self.slot_of[cid] = slot
+        self.ids[slot] = cid
+        self.needs_keyframe.add(cid)
+        # all snakes start from upper left corner
+        self.add_snake(slot, Snake((2, 2), 'RIGHT'))
+        if not self.fruit:
+            self.fruit = self.spawn_fruit()
+
+    def leave(self, cid, notify):
+        if notify:
+            self.queue_event({'id': MSG_DISCONNECT, 'cid': cid})
+        slot = self.slot_of.pop(cid, None)
+        if slot is not None:
+            self.drop_snake(slot)
+            self.ids[slot] = None
+        self.clients.pop(cid, None)
+        self.formats.pop(cid, None)
+        self.needs_keyframe.discard(cid)
+        self.client_views.pop(cid, None)
+
+    def turn(self, cid, desired, seq):
+        slot = self.slot_of.get(cid)
+        if slot is not None and self.snakes[slot].alive:
+            self.snakes[slot].queue_input(desired, seq)
+
+    def queue_event(self, msg):
+        # events raised during update() go out in the same write as the world state
+        self.pending_events.append(msg)
+
+    def update(self):
+        started = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.tick_started(self)
+        self.run_commands()
+        commands_done = time.perf_counter()
+
+        # move and collisions
+        for slot, snake in enumerate(self.snakes):
+            if snake is not None and snake.alive:
+                snake.apply_input()
+                tail = snake.move()
+                if tail is not None:
+                    self.grid.remove(tail, slot)
+                snake.check_collision(self.size)
+                if not snake.alive:
+                    self.queue_event({'id': MSG_LOSE, 'cid': self.ids[slot]})
+                    continue
+                self.grid.add(snake.body[0], slot)
+                if snake.eat(self.fruit):
+                    if snake.score >= WIN_SCORE:
+                        self.queue_event({'id': MSG_WIN, 'cid': self.ids[slot]})
+                        self.running = False
+                    self.fruit = self.spawn_fruit()
+        if self.fruit is None:
+            self.fruit = self.spawn_fruit()
+        moved = time.perf_counter()
+
+        # head-on collisions
+        for slot, snake in enumerate(self.snakes):
+            if snake is not None and snake.alive:
+                other = self.grid.claim_head(snake.body[0], self.tick, slot)
+                if other is not None:
+                    for victim in (other, slot):
+                        if self.snakes[victim].alive:
+                            self.snakes[victim].alive = False
+                            self.queue_event({'id': MSG_LOSE, 'cid': self.ids[victim]})
+
+        # body collisions, a head sharing its cell with any other segment
+        if BODY_COLLISIONS:
+            for slot, snake in enumerate(self.snakes):
+                if snake is not None and snake.alive and self.grid.count(snake.body[0]) > 1:
+                    snake.alive = False
+                    self.queue_event({'id': MSG_LOSE, 'cid': self.ids[slot]})
+
+        checked = time.perf_counter()
+
+        # send events and world state in one write
+        events = self.pending_events
+        self.pending_events = []
+        self.send_world(events)
+        self.tick += 1
+        sent = time.perf_counter()
+        metrics = self.metrics
+        metrics.observe('snake_tick_seconds', sent - started)
+        metrics.observe('snake_tick_phase_seconds{phase="commands"}', commands_done - started)
+        metrics.observe('snake_tick_phase_seconds{phase="move"}', moved - commands_done)
+        metrics.observe('snake_tick_phase_seconds{phase="collisions"}', checked - moved)
+        metrics.observe('snake_tick_phase_seconds{phase="broadcast"}', sent - checked)
+
+    def keyframe_msg(self, view=None):
+        # arrays indexed by slot, None for free slots
+        if view is not None:
+            return self.view_keyframe_msg(view)
+        slots = [slot for slot, cid in enumerate(self.ids) if cid is not None]
+        n = max(slots) + 1 if slots else 0
+        snakes, scores, ids, acks = [None] * n, [None] * n, [None] * n, [0] * n
+        for slot in slots:
+            snake = self.snakes[slot]
+            snakes[slot] = snake.body_list()
+            scores[slot] = snake.score
+            ids[slot] = self.ids[slot]
+            # last input sequence number applied for each player
+            acks[slot] = snake.acked
+        return {
+            'id': MSG_UPDATE,
+            'tick': self.tick,
+            'snakes': snakes,
+            'fruit': self.fruit,
+            'scores': scores,
+            'ids': ids,
+            'acks': acks,
+        }
+
+    def view_keyframe_msg(self, view):
+        # a view usually holds a few of many slots, so it goes out like a delta
+        # against an empty board ([slot, value, ...] lists) instead of sparse arrays
+        visible, fruit = view
+        parts = {key: {} for key in ('move', 'add', 'scores', 'ids', 'acks')}
+        for slot in visible:
+            self.added(parts, slot)
+        msg = self.delta_msg(parts, [], fruit, None)
+        msg['id'] = MSG_UPDATE
+        msg['fruit'] = fruit
+        return msg
+
+    def added(self, parts, slot):
+        # everything about a snake the client doesn't have yet
+        snake = self.snakes[slot]
+        parts['add'][slot] = snake.body_list()
+        parts['scores'][slot] = snake.score
+        parts['ids'][slot] = self.ids[slot]
+        parts['acks'][slot] = snake.acked
+
+    def send_shared(self, events, changes):
+        # everyone sees the whole board, so each message is encoded once per format
+        delta = Batch([self.delta_msg(changes, changes['remove'], self.fruit, self.sent_fruit)]) if changes is not None else None
+        keyframe = None
+        for cid, conn in list(self.clients.items()):
+            fmt = self.formats[cid]
+            prefix = events.encoded(fmt)
+            try:
+                # a delta is refused if the client's queue had to drop a snapshot
+                if delta is not None and cid not in self.needs_keyframe and conn.udp_addr is None:
+                    data = delta.encoded(fmt)
+                    if conn.send_snapshot(data, False, prefix):
+                        self.bytes_sent += len(prefix) + len(data)
+                        continue
+                    prefix = b''
+                if keyframe is None:
+                    keyframe = Batch([self.keyframe_msg()])
+                self.send_keyframe(conn, keyframe.encoded(fmt), prefix)
+            except:
+                pass
+
+    def send_views(self, events, changes):
+        # large boards: each client only gets what is inside its view, so its
+        # payload grows with the players around it rather than the whole room
+        for cid, conn in list(self.clients.items()):
+            fmt = self.formats[cid]
+            prefix = events.encoded(fmt)
+            view = self.view_of(cid)
+            try:
+                if changes is not None and cid not in self.needs_keyframe and conn.udp_addr is None:
+                    data = encode_msg(self.view_delta_msg(changes, cid, view), fmt)
+                    if conn.send_snapshot(data, False, prefix):
+                        self.bytes_sent += len(prefix) + len(data)
+                        self.client_views[cid] = view
+                        continue
+                    prefix = b''
+                self.send_keyframe(conn, encode_msg(self.keyframe_msg(view), fmt), prefix)
+                self.client_views[cid] = view
+            except:
+                pass
+
+    def changes(self):
+        # per slot, what differs from the last tick that was sent. A slot handed
+        # to a new player counts as added, and added snakes carry all their fields.
+        parts = {key: {} for key in ('move', 'add', 'scores', 'ids', 'acks')}
+        for slot, snake in enumerate(self.snakes):
+            if snake is None:
+                continue
+            sent = self.sent_snakes.get(slot)
+            if sent is None or sent[0] != self.ids[slot]:
+                self.added(parts, slot)
+                continue
+            _, head, length, score, acked = sent
+            if snake.body[0] != head or len(snake.body) != length:
+                parts['move'][slot] = (snake.body[0][0], snake.body[0][1], len(snake.body))
+            if snake.score != score:
+                parts['scores'][slot] = snake.score
+            if snake.acked != acked:
+                parts['acks'][slot] = snake.acked
+        parts['remove'] = [slot for slot in self.sent_snakes if self.snakes[slot] is None]
+        return parts
+
+    def delta_msg(self, parts, removed, fruit, sent_fruit):
+        # a moved snake is described by its new head and resulting length,
+        # the client prepends the head and trims the tail. Every field is a flat
+        # list of slots followed by their values: move [slot, x, y, length, ...],
+        # add [slot, body, ...], remove [slot, ...], scores/ids/acks [slot, value, ...]
+        msg = {'id': MSG_DELTA, 'tick': self.tick}
+        if parts['move']:
+            msg['move'] = [v for slot, (x, y, length) in parts['move'].items() for v in (slot, x, y, length)]
+        for key in ('add', 'scores', 'ids', 'acks'):
+            if parts[key]:
+                msg[key] = pairs(parts[key])
+        if removed:
+            msg['remove'] = removed
+        if fruit != sent_fruit:
+            msg['fruit'] = fruit
+        return msg
+
+    def view_rect(self, cid):
+        # VIEW_SIZE cells around the player's head, kept inside the board (the client's camera does the same)
+        w, h = min(VIEW_SIZE[0], self.size[0]), min(VIEW_SIZE[1], self.size[1])
+        slot = self.slot_of.get(cid)
+        hx, hy = self.snakes[slot].body[0] if slot is not None else (self.size[0] // 2, self.size[1] // 2)
+        x0 = min(max(hx - w // 2, 0), self.size[0] - w)
+        y0 = min(max(hy - h // 2, 0), self.size[1] - h)
+        return (x0, y0, x0 + w, y0 + h)
+
+    def view_of(self, cid):
+        x0, y0, x1, y1 = rect = self.view_rect(cid)
+        visible = self.grid.owners_in(rect)
+        if cid in self.slot_of:
+            visible.add(self.slot_of[cid])
+        fruit = self.fruit if self.fruit and x0 <= self.fruit[0] < x1 and y0 <= self.fruit[1] < y1 else None
+        return visible, fruit
+
+    def view_delta_msg(self, changes, cid, view):
+        # the room-wide changes cut down to one client's view: snakes it already had get
+        # the shared entries, ones that came into view are sent whole
+        visible, fruit = view
+        seen, seen_fruit = self.client_views.get(cid, (set(), None))
+        parts = {key: {} for key in ('move', 'add', 'scores', 'ids', 'acks')}
+        for slot in visible:
+            if slot in seen:
+                for key, part in parts.items():
+                    if slot in changes[key]:
+                        part[slot] = changes[key][slot]
+            else:
+                self.added(parts, slot)
+        return self.delta_msg(parts, list(seen - visible), fruit, seen_fruit)
+
+    def send_keyframe(self, conn, data, prefix):
+        # any datagram can be lost, so UDP clients always get full snapshots,
+        # one per datagram; their events stay on the reliable stream
+        if conn.udp_addr is not None and len(data) <= MAX_DATAGRAM:
+            if prefix:
+                conn.send(prefix)
+            conn.send_datagram(data)
+        else:
+            conn.send_snapshot(data, True, prefix)
+        self.bytes_sent += len(prefix) + len(data)
+
+    def send_world(self, events):
+        # keyframes go out every KEYFRAME_INTERVAL ticks and to clients that just joined,
+        # everyone else gets a delta against the previous tick
+        events = Batch(events)
+        changes = None
+        if DELTA_UPDATES and self.sent_snakes is not None and self.tick % KEYFRAME_INTERVAL:
+            changes = self.changes()
+        if VIEW_SIZE:
+            self.send_views(events, changes)
+        else:
+            self.send_shared(events, changes)
+        self.needs_keyframe.clear()
+        self.sent_snakes = {slot: (self.ids[slot], snake.body[0], len(snake.body), snake.score, snake.acked)
+                            for slot, snake in enumerate(self.snakes) if snake is not None}
+        self.sent_fruit = self.fruit
+
+class GameServer:
+    # connections, the lobby and matchmaking; the game itself runs in GameRooms
+    def __init__(self, host=HOST, port=PORT, size=GAME_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.clients = {}
+        self.formats = {}
+        self.last_ping = {}
+        self.lobby = set()
+        self.rooms = {}
+        self.player_rooms = {}
+        self.next_room_id = 1
+        # client ids are small and unique per server, the same port on two hosts can't collide
+        self.client_ids = itertools.count(1)
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        # traffic of clients that have left, live ones are summed at each scrape
+        self.departed_sent = 0
+        self.departed_received = 0
+        self.lock = TimedLock(self.metrics, 'snake_lock_wait_seconds')
+        self.running = True
+        self.loop = None
+        # UDP side channel: socket or transport, login tokens by client, clients by address
+        self.udp = None
+        self.udp_tokens = {}
+        self.udp_peers = {}
+
+    def new_client_id(self):
+        return next(self.client_ids)
+
+    def handle_message(self, client_id, conn, msg):
+        # returns False when the connection should be closed
+        if msg['id'] == MSG_LOGIN and client_id in self.clients:
+            # already logged in, a second login would put a playing client back in the lobby
+            pass
+        elif msg['id'] == MSG_LOGIN:
+            if msg['key'] == LOGIN_KEY:
+                print(f"Login success for client {client_id}")
+                # the response is still json, both sides switch format after it
+                fmt = msg.get('format', FORMAT_JSON)
+                if fmt not in FORMATS:
+                    fmt = FORMAT_JSON
+                resp = {'id': MSG_LOGIN_RESP, 'ok': True, 'format': fmt, 'cid': client_id}
+                if msg.get('udp') and self.udp is not None:
+                    # the client proves a datagram is its own by echoing this token
+                    token = random.getrandbits(31)
+                    self.udp_tokens[client_id] = token
+                    resp.update({'udp_port': self.port, 'token': token})
+                conn.send(encode_msg(resp))
+                with self.lock:
+                    self.formats[client_id] = fmt
+                    self.clients[client_id] = conn
+                    self.last_ping[client_id] = time.time()
+                    self.lobby.add(client_id)
+            else:
+                print(f"Login failed for client {client_id}")
+                conn.send(encode_msg({'id': MSG_LOGIN_RESP, 'ok': False}))
+                return False
+        elif client_id not in self.clients:
+            pass
+        elif msg['id'] == MSG_START:
+            room = self.join_room(client_id, conn)
+            if room:
+                print(f"Client {client_id} joined room {room.room_id}")
+        elif msg['id'] == MSG_INPUT:
+            room = self.player_rooms.get(client_id)
+            if room:
+                room.steer(client_id, msg['dir'], msg.get('seq'))
+        elif msg['id'] == MSG_PING:
+            self.last_ping[client_id] = time.time()
+            conn.send(PONG_BYTES[self.formats[client_id]])
+            # the client's last measured round trip, in microseconds
+            rtt = msg.get('rtt')
+            if type(rtt) is int and rtt >= 0:
+                self.metrics.observe('snake_rtt_seconds', rtt / 1e6)
+        return True
+
+    def handle_datagram(self, data, addr):
+        # datagrams carry inputs only; a new address is bound to a client by the
+        # login token it sends, and unknown or malformed datagrams are ignored
+        cid = self.udp_peers.get(addr)
+        try:
+            msg = decode_msg(data, self.formats.get(cid, FORMAT_JSON))
+            if cid is not None:
+                self.clients[cid].bytes_received += len(data)
+            else:
+                cid = msg.get('cid')
+                conn = self.clients.get(cid)
+                if msg['id'] != MSG_LOGIN or conn is None or self.udp_tokens.get(cid) != msg.get('token'):
+                    return
+                with self.lock:
+                    self.udp_peers[addr] = cid
+                    conn.bind_udp(self.udp, addr)
+            if msg['id'] == MSG_LOGIN:
+                # acknowledges the binding, the client repeats its hello until this arrives
+                self.udp.sendto(encode_msg({'id': MSG_LOGIN_RESP, 'ok': True}, self.formats[cid]), addr)
+            elif msg['id'] == MSG_INPUT:
+                room = self.player_rooms.get(cid)
+                if room:
+                    # the same inputs arrive several times, steer() keeps the new ones
+                    for seq, direction in msg['inputs']:
+                        room.steer(cid, direction, seq)
+        except (ValueError, KeyError, TypeError, AttributeError, RecursionError, OSError):
+            pass
+
+    def join_room(self, client_id, conn):
+        # matchmaking: fill the first open room, or open a new one
+        with self.lock:
+            if client_id not in self.lobby:
+                return None
+            room = next((r for r in self.rooms.values() if r.is_open()), None)
+            created = room is None
+            if created:
+                room = GameRoom(self.next_room_id, self.size, metrics=self.metrics)
+                self.next_room_id += 1
+                if REPLAY_DIR:
+                    self.record(room)
+                self.rooms[room.room_id] = room
+            self.lobby.discard(client_id)
+            self.player_rooms[client_id] = room
+            room.add_player(client_id, conn, self.formats[client_id])
+        if created:
+            self.start_room(room)
+        return room
+
+    def record(self, room):
+        # room ids restart with every process, the pid and time keep file names apart
+        path = os.path.join(REPLAY_DIR, f"room{room.room_id}-{os.getpid()}-{int(time.time())}.replay")
+        try:
+            os.makedirs(REPLAY_DIR, exist_ok=True)
+            room.recorder = ReplayRecorder(path, room)
+        except OSError as e:
+            print(f"Room {room.room_id} not recorded: {e}")
+
+    def close_room(self, room):
+        # a finished match sends its players back to the lobby
+        if room.recorder is not None:
+            try:
+                room.recorder.close(room)
+                print(f"Room {room.room_id} recorded to {room.recorder.path}")
+            except OSError as e:
+                print(f"Room {room.room_id} recording failed: {e}")
+        with self.lock:
+            self.rooms.pop(room.room_id, None)
+            for cid in list(room.members):
+                if self.player_rooms.get(cid) is room:
+                    del self.player_rooms[cid]
+                    if cid in self.clients:
+                        self.lobby.add(cid)
+        print(f"Room {room.room_id} closed")
+
+    def remove_client(self, client_id, notify=False):
+        with self.lock:
+            room = self.player_rooms.pop(client_id, None)
+            if room:
+                room.remove_player(client_id, notify)
+            self.lobby.discard(client_id)
+            if client_id in self.clients:
+                conn = self.clients.pop(client_id)
+                self.udp_peers.pop(conn.udp_addr, None)
+                self.departed_sent += conn.bytes_sent
+                self.departed_received += conn.bytes_received
+            self.udp_tokens.pop(client_id, None)
+            if client_id in self.last_ping:
+                del self.last_ping[client_id]
+            if client_id in self.formats:
+                del self.formats[client_id]
+
+    def tick_stats(self):
+        # worst tick timings across the rooms on this server
+        rooms = [room.scheduler.stats.summary() for room in list(self.rooms.values())]
+        return {
+            'rooms': len(rooms),
+            'p99_ms': max((r['p99_ms'] for r in rooms), default=0.0),
+            'max_ms': max((r['max_ms'] for r in rooms), default=0.0),
+            'overruns': sum(r['overruns'] for r in rooms),
+            'skipped': sum(r['skipped'] for r in rooms),
+        }
+
+    def collect_metrics(self):
+        # gauges and totals read at every scrape
+        clients = list(self.clients.items())
+        rooms = list(self.rooms.values())
+        values = [
+            ('gauge', 'snake_players', len(clients)),
+            ('gauge', 'snake_lobby_players', len(self.lobby)),
+            ('gauge', 'snake_rooms', len(rooms)),
+            ('gauge', 'snake_room_tick_overruns', sum(room.scheduler.stats.overruns for room in rooms)),
+            ('counter', 'snake_bytes_sent_total', self.departed_sent + sum(conn.bytes_sent for _, conn in clients)),
+            ('counter', 'snake_bytes_received_total', self.departed_received + sum(conn.bytes_received for _, conn in clients)),
+        ]
+        for cid, conn in clients:
+            values.append(('gauge', f'snake_client_bytes_sent{{cid="{cid}"}}', conn.bytes_sent))
+            values.append(('gauge', f'snake_client_bytes_received{{cid="{cid}"}}', conn.bytes_received))
+        return values
+
+    def sweep_idle(self):
+        started = time.perf_counter()
+        now = time.time()
+        with self.lock:
+            stale = [cid for cid, t in self.last_ping.items() if now - t > 5]
+        for cid in stale:
+            conn = self.clients.get(cid)
+            if conn:
+                try:
+                    conn.send(encode_msg({'id': MSG_DISCONNECT, 'cid': cid}, self.formats[cid]))
+                    conn.close()
+                except:
+                    pass
+            self.remove_client(cid, notify=True)
+        self.metrics.observe('snake_sweep_seconds', time.perf_counter() - started)
+
+    def handle_client(self, sock, addr):
+        client_id = self.new_client_id()
+        reader = MessageReader()
+        conn = SocketConnection(sock)
         try:
             while self.running:
-                data = conn.recv(1024)
-                if not data:
+                n = reader.recv_into(sock)
+                if not n:
                     break
-                buffer += data.decode()
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if not line.strip():
-                        continue
-                    msg = json.loads(line)
-
-                    if msg['id'] == MSG_LOGIN:
-                        if msg['key'] == LOGIN_KEY:
-                            print(f"Login success for client {client_id}")
-                            conn.send((json.dumps({'id': MSG_LOGIN_RESP, 'ok': True}) + '\n').encode())
-                            with self.lock:
-                                self.clients[client_id] = conn
-                                # all snakes start from upper left corner
-                                self.player_numbers[client_id] = self.next_player_num
-                                self.next_player_num += 1
-                                self.snakes[client_id] = Snake((2, 2), 'RIGHT')
-                                self.last_ping[client_id] = time.time()
-                                if not self.fruit:
-                                    self.fruit = self.spawn_fruit()
-                            logged_in = True
-                        else:
-                            print(f"Login failed for client {client_id}")
-                            conn.send((json.dumps({'id': MSG_LOGIN_RESP, 'ok': False}) + '\n').encode())
-                            return
-                    elif not logged_in:
-                        continue
-                    elif msg['id'] == MSG_START:
-                        print(f"Game started")
-                    elif msg['id'] == MSG_INPUT:
-                        with self.lock:
-                            if client_id in self.snakes and self.snakes[client_id].alive:
-                                # prevent 180-degree turns
-                                desired = msg['dir']
-                                cur = self.snakes[client_id].last_input
-                                opposites = {('UP','DOWN'),('DOWN','UP'),('LEFT','RIGHT'),('RIGHT','LEFT')}
-                                if (cur, desired) not in opposites:
-                                    self.snakes[client_id].last_input = desired
-                    elif msg['id'] == MSG_PING:
-                        self.last_ping[client_id] = time.time()
-                        conn.send((json.dumps({'id': MSG_PONG}) + '\n').encode())
+                conn.bytes_received += n
+                while True:
+                    msg = reader.next_message()
+                    if msg is None:
+                        break
+                    if not self.handle_message(client_id, conn, msg):
+                        return
+                    reader.fmt = self.formats.get(client_id, FORMAT_JSON)
         except Exception as e:
             print(f"Client {client_id} error: {e}")
         finally:
-            with self.lock:
-                if client_id in self.snakes:
-                    del self.snakes[client_id]
-                if client_id in self.clients:
-                    del self.clients[client_id]
-                if client_id in self.last_ping:
-                    del self.last_ping[client_id]
-                if client_id in self.player_numbers:
-                    del self.player_numbers[client_id]
+            self.remove_client(client_id)
             conn.close()
 
-    def broadcast(self, msg):
-        for conn in list(self.clients.values()):
-            try:
-                conn.send((json.dumps(msg) + '\n').encode())
-            except:
-                pass
+    def start_room(self, room):
+        if self.loop:
+            self.loop.create_task(self.room_loop_async(room))
+        else:
+            threading.Thread(target=self.room_loop, args=(room,), daemon=True).start()
 
-    def update(self):
-        with self.lock:
-            # move and collisions
-            for cid, snake in list(self.snakes.items()):
-                if snake.alive:
-                    snake.move()
-                    snake.check_collision(GAME_SIZE)
-                    if not snake.alive:
-                        self.broadcast({'id': 'lose', 'cid': cid})
-                        continue
-                    if snake.eat(self.fruit):
-                        if snake.score >= WIN_SCORE:
-                            self.broadcast({'id': 'win', 'cid': cid})
-                            self.running = False
-                        self.fruit = self.spawn_fruit()
-
-            # head-on collisions
-            positions = {}
-            for cid, snake in self.snakes.items():
-                if snake.alive:
-                    positions.setdefault(tuple(snake.body[0]), []).append(cid)
-            for pos, cids in positions.items():
-                if len(cids) > 1:
-                    for cid in cids:
-                        self.snakes[cid].alive = False
-                        self.broadcast({'id': 'lose', 'cid': cid})
-
-            # disconnect
-            now = time.time()
-            for cid in list(self.last_ping.keys()):
-                if now - self.last_ping[cid] > 5:
-                    self.broadcast({'id': MSG_DISCONNECT, 'cid': cid})
-                    if cid in self.clients:
-                        try:
-                            self.clients[cid].close()
-                        except:
-                            pass
-                        del self.clients[cid]
-                    if cid in self.snakes:
-                        del self.snakes[cid]
-                    del self.last_ping[cid]
-
-            # send world state
-            self.broadcast({
-                'id': MSG_UPDATE,
-                'snakes': {cid: snake.body for cid, snake in self.snakes.items()},
-                'fruit': self.fruit,
-                'scores': {cid: snake.score for cid, snake in self.snakes.items()},
-                'players': self.player_numbers
-            })
+    def start_metrics(self, port=METRICS_PORT):
+        if port:
+            try:
+                serve_metrics(self.metrics, self.host, port)
+            except OSError as e:
+                print(f"Metrics endpoint not started: {e}")
 
     def run(self):
+        self.start_metrics()
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen(8)
-        print(f"Server listening on {HOST}:{PORT}")
+        s.bind((self.host, self.port))
+        s.listen(LISTEN_BACKLOG)
+        print(f"Server listening on {self.host}:{self.port}")
+        if UDP_ENABLED:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind((self.host, self.port))
+            threading.Thread(target=self.udp_loop, daemon=True).start()
         threading.Thread(target=self.game_loop, daemon=True).start()
         while self.running:
             conn, addr = s.accept()
             threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True).start()
 
+    def udp_loop(self):
+        while self.running:
+            try:
+                data, addr = self.udp.recvfrom(65536)
+            except ConnectionResetError:
+                # Windows reports an earlier datagram's ICMP unreachable this way
+                continue
+            except OSError as e:
+                print(f"UDP channel stopped: {e}")
+                return
+            self.handle_datagram(data, addr)
+
     def game_loop(self):
         while self.running:
-            self.update()
+            self.sweep_idle()
             time.sleep(1/FPS)
 
+    def room_loop(self, room):
+        # a room whose update() raised is closed all the same, not left open to matchmaking
+        try:
+            while room.running and self.running:
+                time.sleep(room.scheduler.delay())
+                room.scheduler.run_due(functools.partial(self.metrics.profiled, room.update))
+        finally:
+            room.running = False
+            self.close_room(room)
+
+    # event-loop mode: every client socket is multiplexed on one asyncio loop
+    def run_async(self):
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.start_metrics()
+        server = await self.loop.create_server(lambda: ClientProtocol(self), self.host, self.port,
+                                               reuse_address=True, backlog=LISTEN_BACKLOG)
+        if UDP_ENABLED:
+            self.udp, _ = await self.loop.create_datagram_endpoint(lambda: DatagramProtocol(self),
+                                                                   local_addr=(self.host, self.port))
+        print(f"Server listening on {self.host}:{self.port} (async)")
+        async with server:
+            await self.game_loop_async()
+
+    async def game_loop_async(self):
+        while self.running:
+            self.sweep_idle()
+            await asyncio.sleep(1/FPS)
+
+    async def room_loop_async(self, room):
+        try:
+            while room.running and self.running:
+                await asyncio.sleep(room.scheduler.delay())
+                room.scheduler.run_due(functools.partial(self.metrics.profiled, room.update))
+        finally:
+            room.running = False
+            self.close_room(room)
+
+def raise_fd_limit():
+    # thousands of connections need more than the default 1024 descriptors
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
 if __name__ == '__main__':
-    GameServer().run()
\ No newline at end of file
+    if SERVER_MODE == 'async':
+        GameServer().run_async()
+    else:
+        GameServer().run()
\ No newline at end of file